@@ -0,0 +1,348 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from typing import Dict, List, Optional
+
+from benchmarks.synthetic_corpus import generate_corpus
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Throughput drop (fraction of the baseline) above which a run is a regression
+DEFAULT_MAX_REGRESSION = 0.1
+# Seconds between two samples of the memory of the run
+RSS_SAMPLE_INTERVAL = 0.1
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int, server_args: List[str]) -> subprocess.Popen:
+    """Start the stub server in its own process, so that its CPU is not counted"""
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.stub_server", "--port", str(port), *server_args],
+        cwd=REPO_PATH,
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1)
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError("The stub server exited before accepting requests")
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The stub server did not start in 30 seconds")
+
+
+def process_tree(pid: int) -> List[int]:
+    """The process and its descendants (Linux /proc)"""
+    pids, stack = [], [pid]
+    while stack:
+        pid = stack.pop()
+        pids.append(pid)
+        try:
+            for task in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{task}/children", "r") as file:
+                    stack.extend(int(child) for child in file.read().split())
+        except OSError:
+            # the process exited
+            continue
+    return pids
+
+
+def tree_rss_kb(pid: int) -> int:
+    """
+    Resident memory of the process and its descendants, in kilobytes (the pages the
+    forked workers still share with the parent are counted in each of them)
+    """
+    total = 0
+    for tree_pid in process_tree(pid):
+        try:
+            with open(f"/proc/{tree_pid}/status", "r") as file:
+                for line in file:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class RssSampler(threading.Thread):
+    """Peak of the summed resident memory of a process tree, sampled until stopped"""
+
+    def __init__(self, pid: int):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.peak_kb = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak_kb = max(self.peak_kb, tree_rss_kb(self.pid))
+            self.stopped.wait(RSS_SAMPLE_INTERVAL)
+
+    def stop(self) -> Optional[float]:
+        """:return: The peak in megabytes, None where /proc is not available"""
+        self.stopped.set()
+        self.join()
+        return self.peak_kb / 1024 if os.path.isdir("/proc") else None
+
+
+def run_pipeline(
+    corpus: Dict[str, str],
+    save_path: str,
+    url: str,
+    backend: str,
+    strategy: str,
+    engine: str,
+    concurrency: int,
+    extra_args: List[str],
+) -> Dict:
+    """
+    Run main.py on the corpus and measure it from the outside: the wall time, the
+    CPU time of main.py and its worker processes, and the peak of their summed RSS
+    :return: The measures and the run summary written by main.py
+    """
+    command = [
+        sys.executable,
+        os.path.join(REPO_PATH, "main.py"),
+        "--data_path", corpus["data_path"],
+        "--path", corpus["path"],
+        "--save_path", save_path,
+        "--model", "stub-model",
+        "--backend", backend,
+        "--url", url,
+        "--strategy", strategy,
+        "--engine", engine,
+        "--num_processes", str(concurrency),
+        "--max_in_flight", str(concurrency),
+        "--max_concurrency", str(concurrency),
+        "--timeout", "60",
+        *extra_args,
+    ]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=REPO_PATH, stdout=subprocess.DEVNULL)
+    sampler = RssSampler(process.pid)
+    sampler.start()
+    # the CPU time of the run includes the worker processes it waited for, its
+    # ru_maxrss is only the one of the largest process
+    _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start
+    peak_rss_mb = sampler.stop()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"main.py exited with {process.returncode}: {' '.join(command)}")
+
+    with open(os.path.join(save_path, "run_summary.json"), "r") as file:
+        summary = json.load(file)
+    cpu_time = usage.ru_utime + usage.ru_stime
+    return {
+        "strategy": strategy,
+        "engine": engine,
+        "concurrency": concurrency,
+        "queries": summary["queries"],
+        "finished": summary["finished"],
+        "requests": summary["requests"],
+        "requests_per_sec": summary["requests_per_sec"],
+        "latency_p50": summary["latency_p50"],
+        "latency_p99": summary["latency_p99"],
+        "process_wall_time": wall_time,
+        "cpu_time": cpu_time,
+        "cpu_per_request": cpu_time / summary["requests"] if summary["requests"] else None,
+        "peak_rss_mb": peak_rss_mb,
+        # kilobytes on Linux
+        "max_process_rss_mb": usage.ru_maxrss / 1024,
+    }
+
+
+def run_key(run: Dict) -> str:
+    return f"{run['strategy']}/{run['engine']}/{run['concurrency']}"
+
+
+def find_regressions(runs: List[Dict], baseline: List[Dict], max_regression: float) -> List[str]:
+    """:return: A description of each run slower than its baseline by more than max_regression"""
+    baseline_runs = {run_key(run): run for run in baseline}
+    regressions = []
+    for run in runs:
+        reference = baseline_runs.get(run_key(run))
+        if reference is None or not reference["requests_per_sec"]:
+            continue
+        ratio = run["requests_per_sec"] / reference["requests_per_sec"]
+        if ratio < 1 - max_regression:
+            regressions.append(
+                f"{run_key(run)}: {run['requests_per_sec']:.1f} requests/sec, "
+                f"baseline {reference['requests_per_sec']:.1f} ({ratio - 1:+.0%})"
+            )
+    return regressions
+
+
+def print_runs(runs: List[Dict]):
+    header = (
+        f"{'strategy':<8} {'engine':<6} {'conc':>5} {'requests':>8} {'req/s':>8} "
+        f"{'p50 ms':>8} {'p99 ms':>8} {'cpu s':>7} {'cpu/req ms':>10} {'rss MB':>7}"
+    )
+    print(header)
+    print("-" * len(header))
+    for run in runs:
+        print(
+            f"{run['strategy']:<8} {run['engine']:<6} {run['concurrency']:>5} "
+            f"{run['requests']:>8} {run['requests_per_sec']:>8.1f} "
+            f"{1000 * (run['latency_p50'] or 0):>8.1f} {1000 * (run['latency_p99'] or 0):>8.1f} "
+            f"{run['cpu_time']:>7.2f} {1000 * (run['cpu_per_request'] or 0):>10.2f} "
+            f"{run['peak_rss_mb'] or 0:>7.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run main.py end to end against a local stub LLM server at several "
+        "concurrency levels and report its throughput, latency, CPU and memory. "
+        "Run from the repository root: python -m benchmarks.run_benchmark"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        help="Number of worker processes (pool) or requests in flight (async)",
+        default=[4, 16, 64],
+    )
+    parser.add_argument(
+        "--engines", type=str, nargs="+", choices=["pool", "async"], default=["pool", "async"]
+    )
+    parser.add_argument(
+        "--strategies", type=str, nargs="+", choices=["batchqa", "cot"], default=["batchqa"]
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        help="API served by the stub server to the pipeline",
+        choices=["openai-compatible", "tgi"],
+        default="openai-compatible",
+    )
+    parser.add_argument("--num_docs", type=int, default=20)
+    parser.add_argument("--pairs_per_doc", type=int, default=10)
+    parser.add_argument("--sentences_per_doc", type=int, default=40)
+    parser.add_argument(
+        "--latency",
+        type=str,
+        help="Distribution of the server latency",
+        choices=["fixed", "uniform", "lognormal"],
+        default="lognormal",
+    )
+    parser.add_argument("--latency_ms", type=float, help="Median server latency", default=50.0)
+    parser.add_argument("--latency_sigma", type=float, default=0.5)
+    parser.add_argument(
+        "--tokens_per_sec",
+        type=float,
+        help="Generation speed of the server per request (default: 0, instantaneous)",
+        default=0.0,
+    )
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0)
+    parser.add_argument(
+        "--main_args",
+        type=str,
+        nargs=argparse.REMAINDER,
+        help="Other arguments of main.py, e.g. --main_args --stream --doc_window 4",
+        default=[],
+    )
+    parser.add_argument(
+        "--output", type=str, help="JSON file to save the measures of the runs", default=None
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        help="JSON file saved by a previous --output, exit with an error if a run is slower",
+        default=None,
+    )
+    parser.add_argument(
+        "--max_regression",
+        type=float,
+        help="Throughput drop allowed against the baseline, as a fraction",
+        default=DEFAULT_MAX_REGRESSION,
+    )
+    parser.add_argument(
+        "--work_path",
+        type=str,
+        help="Folder for the corpus and the results (default: a temporary folder, removed)",
+        default=None,
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    work_path = args.work_path or tempfile.mkdtemp(prefix="benchmark_")
+    corpus = generate_corpus(
+        os.path.join(work_path, "corpus"),
+        num_docs=args.num_docs,
+        pairs_per_doc=args.pairs_per_doc,
+        sentences_per_doc=args.sentences_per_doc,
+        seed=args.seed,
+    )
+
+    port = free_port()
+    server = start_server(
+        port,
+        [
+            "--latency", args.latency,
+            "--latency_ms", str(args.latency_ms),
+            "--latency_sigma", str(args.latency_sigma),
+            "--tokens_per_sec", str(args.tokens_per_sec),
+            "--error_rate", str(args.error_rate),
+            "--rate_limit_rate", str(args.rate_limit_rate),
+            "--seed", str(args.seed),
+        ],
+    )
+    runs = []
+    try:
+        for strategy in args.strategies:
+            for engine in args.engines:
+                for concurrency in args.concurrency:
+                    save_path = os.path.join(work_path, f"{strategy}_{engine}_{concurrency}")
+                    # every run starts from scratch, not from the results of a previous one
+                    shutil.rmtree(save_path, ignore_errors=True)
+                    print(f"Running {strategy} on the {engine} engine, concurrency {concurrency}")
+                    runs.append(
+                        run_pipeline(
+                            corpus,
+                            save_path,
+                            f"http://127.0.0.1:{port}/",
+                            args.backend,
+                            strategy,
+                            engine,
+                            concurrency,
+                            args.main_args,
+                        )
+                    )
+    finally:
+        server.terminate()
+        server.wait()
+        if args.work_path is None:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    print_runs(runs)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(runs, file, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+        regressions = find_regressions(runs, baseline, args.max_regression)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No run more than {args.max_regression:.0%} slower than the baseline")
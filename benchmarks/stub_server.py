@@ -0,0 +1,331 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+# Rough number of characters per token, as in llm_requests.rate_limit
+CHARS_PER_TOKEN = 4
+
+
+class ServerProfile:
+    """
+    How the stub server behaves: the distribution of the time to the first token,
+    the rate at which the tokens are generated and how often a request fails
+    """
+
+    def __init__(
+        self,
+        latency: str = "lognormal",
+        latency_ms: float = 50.0,
+        latency_sigma: float = 0.5,
+        tokens_per_sec: float = 0.0,
+        completion_tokens: int = 20,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        """
+        :param latency: Distribution of the time to the first token: fixed, uniform
+        (between 0 and twice latency_ms) or lognormal (median latency_ms)
+        :param tokens_per_sec: Generation speed of each request (0: instantaneous)
+        :param completion_tokens: Length of the explanation added to each answer
+        :param error_rate: Fraction of the requests answered with a 500 error
+        :param rate_limit_rate: Fraction of the requests answered with a 429 error
+        """
+        if latency not in ["fixed", "uniform", "lognormal"]:
+            raise ValueError(f"Unknown latency distribution {latency}")
+        self.latency = latency
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.tokens_per_sec = tokens_per_sec
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def first_token_delay(self) -> float:
+        with self.lock:
+            if self.latency == "fixed":
+                delay = self.latency_ms
+            elif self.latency == "uniform":
+                delay = self.random.uniform(0, 2 * self.latency_ms)
+            else:
+                delay = self.random.lognormvariate(0, self.latency_sigma) * self.latency_ms
+        return delay / 1000
+
+    def token_delay(self) -> float:
+        return 1 / self.tokens_per_sec if self.tokens_per_sec else 0.0
+
+    def draw_error(self) -> Optional[int]:
+        """:return: The status code of a failed request, None if it succeeds"""
+        with self.lock:
+            draw = self.random.random()
+        if draw < self.rate_limit_rate:
+            return 429
+        if draw < self.rate_limit_rate + self.error_rate:
+            return 500
+        return None
+
+
+def answer(prompt: str, completion_tokens: int) -> str:
+    """
+    The response to the last message of a conversation: an answer to each numbered
+    question of a batchqa prompt, or a yes/no answer to a cot question. The answers
+    are a deterministic function of the question so that reruns are comparable.
+    """
+
+    def yes_or_no(text: str) -> str:
+        return "yes" if hashlib.md5(text.encode("utf-8")).digest()[0] < 64 else "no"
+
+    question_ids = re.findall(r"(P\d+-)?Q(\d+): (.*?)$", prompt, flags=re.MULTILINE)
+    if question_ids:
+        lines = [
+            f"{pair_id}A{q_id}: {yes_or_no(pair_id + question)}"
+            for pair_id, q_id, question in question_ids
+        ]
+    else:
+        lines = [yes_or_no(prompt[-200:])]
+    explanation = " ".join(["because"] * completion_tokens)
+    return "\n".join(lines) + "\n" + explanation
+
+
+def split_tokens(text: str) -> List[str]:
+    return [text[i : i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+
+
+def make_handler(profile: ServerProfile, model: str):
+    class StubHandler(BaseHTTPRequestHandler):
+        """OpenAI compatible (/v1/chat/completions) and TGI (/, /generate) routes"""
+
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status: int, body, headers: Dict = None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_events(self, events):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for event in events:
+                chunk = f"data:{event}\n\n".encode("utf-8")
+                self.wfile.write(f"{len(chunk):x}\r\n".encode("utf-8") + chunk + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+
+        def do_GET(self):
+            if self.path.rstrip("/") in ["/health", "/v1/models"]:
+                self.send_json(200, {"status": "ok", "data": [{"id": model}]})
+            else:
+                self.send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            if self.path.rstrip("/").endswith("/chat/completions"):
+                prompt = request["messages"][-1]["content"]
+                prompt_tokens = sum(
+                    len(message["content"]) for message in request["messages"]
+                ) // CHARS_PER_TOKEN
+                chat = True
+            elif self.path.rstrip("/") in ["", "/generate", "/generate_stream"]:
+                # the llama-2 template puts the last question in the last [INST] block
+                prompt = request["inputs"].split("[INST]")[-1].replace("[/INST]", "")
+                prompt_tokens = len(request["inputs"]) // CHARS_PER_TOKEN
+                chat = False
+            else:
+                self.send_json(404, {"error": "not found"})
+                return
+
+            time.sleep(profile.first_token_delay())
+            status = profile.draw_error()
+            if status == 429:
+                self.send_json(
+                    429, {"error": {"message": "Rate limit reached"}}, {"Retry-After": "1"}
+                )
+                return
+            if status is not None:
+                self.send_json(status, {"error": {"message": "Internal server error"}})
+                return
+
+            text = answer(prompt, profile.completion_tokens)
+            tokens = split_tokens(text)
+            stream = request.get("stream") or self.path.endswith("/generate_stream")
+            if stream:
+                self.stream(tokens, chat, request, prompt_tokens)
+                return
+            time.sleep(profile.token_delay() * len(tokens))
+            if chat:
+                self.send_json(200, self.chat_completion(text, prompt_tokens, len(tokens)))
+            else:
+                self.send_json(200, [self.generation(text, len(tokens))])
+
+        def chat_completion(self, text: str, prompt_tokens: int, completion_tokens: int) -> Dict:
+            return {
+                "id": "stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": text},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            }
+
+        def generation(self, text: str, generated_tokens: int) -> Dict:
+            return {
+                "generated_text": text,
+                "details": {
+                    "finish_reason": "eos_token",
+                    "generated_tokens": generated_tokens,
+                    "seed": None,
+                    "prefill": [],
+                    "tokens": [],
+                },
+            }
+
+        def stream(self, tokens: List[str], chat: bool, request: Dict, prompt_tokens: int):
+            def events():
+                for i, token in enumerate(tokens):
+                    time.sleep(profile.token_delay())
+                    if chat:
+                        yield json.dumps(
+                            {
+                                "id": "stub",
+                                "object": "chat.completion.chunk",
+                                "created": int(time.time()),
+                                "model": model,
+                                "choices": [
+                                    {"index": 0, "delta": {"content": token}, "finish_reason": None}
+                                ],
+                            }
+                        )
+                    else:
+                        last = i == len(tokens) - 1
+                        yield json.dumps(
+                            {
+                                "token": {"id": i, "text": token, "logprob": 0.0, "special": False},
+                                "generated_text": "".join(tokens) if last else None,
+                                "details": None,
+                            }
+                        )
+                if chat:
+                    if (request.get("stream_options") or {}).get("include_usage"):
+                        yield json.dumps(
+                            {
+                                "id": "stub",
+                                "object": "chat.completion.chunk",
+                                "created": int(time.time()),
+                                "model": model,
+                                "choices": [],
+                                "usage": self.chat_completion("", prompt_tokens, len(tokens))[
+                                    "usage"
+                                ],
+                            }
+                        )
+                    yield "[DONE]"
+
+            try:
+                self.send_events(events())
+            except (BrokenPipeError, ConnectionResetError):
+                # the client stopped the generation early
+                pass
+
+    return StubHandler
+
+
+def serve(host: str, port: int, profile: ServerProfile, model: str = "stub-model") -> ThreadingHTTPServer:
+    """:return: The server, which the caller runs with serve_forever"""
+    server = ThreadingHTTPServer((host, port), make_handler(profile, model))
+    server.daemon_threads = True
+    # the benchmarks open hundreds of connections at once
+    server.request_queue_size = 1024
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Local OpenAI compatible and TGI compatible LLM server for the benchmarks"
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--model", type=str, default="stub-model")
+    parser.add_argument(
+        "--latency",
+        type=str,
+        help="Distribution of the time to the first token",
+        choices=["fixed", "uniform", "lognormal"],
+        default="lognormal",
+    )
+    parser.add_argument(
+        "--latency_ms", type=float, help="Median time to the first token", default=50.0
+    )
+    parser.add_argument(
+        "--latency_sigma", type=float, help="Sigma of the lognormal latency", default=0.5
+    )
+    parser.add_argument(
+        "--tokens_per_sec",
+        type=float,
+        help="Generation speed of each request (default: 0, instantaneous)",
+        default=0.0,
+    )
+    parser.add_argument(
+        "--completion_tokens",
+        type=int,
+        help="Length of the explanation added to each answer",
+        default=20,
+    )
+    parser.add_argument(
+        "--error_rate", type=float, help="Fraction of requests failing with a 500", default=0.0
+    )
+    parser.add_argument(
+        "--rate_limit_rate",
+        type=float,
+        help="Fraction of requests failing with a 429",
+        default=0.0,
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    profile = ServerProfile(
+        latency=args.latency,
+        latency_ms=args.latency_ms,
+        latency_sigma=args.latency_sigma,
+        tokens_per_sec=args.tokens_per_sec,
+        completion_tokens=args.completion_tokens,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=args.seed,
+    )
+    server = serve(args.host, args.port, profile, args.model)
+    print(f"Serving {args.model} on http://{args.host}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
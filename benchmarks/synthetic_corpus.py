@@ -0,0 +1,166 @@
+import argparse
+import os
+import random
+from typing import Dict, List
+from xml.etree.ElementTree import Element, ElementTree, SubElement
+from xml.sax.saxutils import escape
+
+PROBLEMS = ["chest pain", "shortness of breath", "fever", "nausea", "hypotension", "a rash"]
+TREATMENTS = ["surgery", "antibiotics", "a CT scan", "dialysis", "a blood transfusion"]
+FILLER = [
+    "The patient was seen by the team .",
+    "Vital signs were stable throughout the stay .",
+    "Labs were notable for a mild leukocytosis .",
+    "The family was updated on the plan of care .",
+    "Physical therapy evaluated the patient .",
+]
+
+
+def make_report(rng: random.Random, num_sentences: int, num_events: int) -> Dict:
+    """
+    A clinical note shaped like the i2b2 2012 ones: admission and discharge dates,
+    then sentences mentioning the events, with their character offsets
+    """
+    text = "\n"
+    events, timexs, sectimes = [], [], []
+    for t_idx, label in enumerate(["Admission Date :", "Discharge Date :"]):
+        date = f"2010-0{rng.randint(1, 9)}-{rng.randint(10, 28)}"
+        text += label + "\n"
+        start = len(text)
+        text += date + "\n"
+        timex = {"id": f"T{t_idx}", "start": str(start), "end": str(start + len(date)), "text": date}
+        timexs.append(timex)
+        sectimes.append(
+            {
+                "id": f"S{t_idx}",
+                "start": timex["start"],
+                "end": timex["end"],
+                "text": date,
+                "type": "ADMISSION" if t_idx == 0 else "DISCHARGE",
+                "dvalue": date,
+            }
+        )
+
+    event_sentences = set(rng.sample(range(num_sentences), min(num_events, num_sentences)))
+    for s_idx in range(num_sentences):
+        if s_idx not in event_sentences:
+            text += rng.choice(FILLER) + " "
+            continue
+        is_problem = rng.random() < 0.5
+        mention = rng.choice(PROBLEMS if is_problem else TREATMENTS)
+        prefix = "The patient had " if is_problem else "He underwent "
+        text += prefix
+        start = len(text)
+        text += mention + " . "
+        events.append(
+            {
+                "id": f"E{len(events)}",
+                "start": str(start),
+                "end": str(start + len(mention)),
+                "text": mention,
+                "type": "PROBLEM" if is_problem else "TREATMENT",
+            }
+        )
+    return {"text": text + "\n", "events": events, "timexs": timexs, "sectimes": sectimes}
+
+
+def write_report(report: Dict, path: str):
+    with open(path, "w") as file:
+        file.write('<?xml version="1.0" encoding="UTF-8" ?>\n')
+        file.write("<ClinicalNarrativeTemporalAnnotation>\n")
+        file.write(f"<TEXT><![CDATA[{report['text']}]]></TEXT>\n<TAGS>\n")
+        for event in report["events"]:
+            file.write(
+                f'<EVENT id="{event["id"]}" start="{event["start"]}" end="{event["end"]}" '
+                f'text="{escape(event["text"])}" modality="FACTUAL" polarity="POS" '
+                f'type="{event["type"]}" />\n'
+            )
+        for timex in report["timexs"]:
+            file.write(
+                f'<TIMEX3 id="{timex["id"]}" start="{timex["start"]}" end="{timex["end"]}" '
+                f'text="{timex["text"]}" type="DATE" val="{timex["text"]}" mod="NA" />\n'
+            )
+        for sectime in report["sectimes"]:
+            file.write(
+                f'<SECTIME id="{sectime["id"]}" start="{sectime["start"]}" end="{sectime["end"]}" '
+                f'text="{sectime["text"]}" type="{sectime["type"]}" dvalue="{sectime["dvalue"]}" />\n'
+            )
+        file.write("</TAGS>\n</ClinicalNarrativeTemporalAnnotation>\n")
+
+
+def make_pairs(rng: random.Random, report: Dict, num_pairs: int) -> List[Dict]:
+    mentions = report["events"] + report["timexs"]
+    candidates = [(a, b) for a in mentions for b in mentions if a["id"] != b["id"]]
+    pairs = []
+    for source, target in rng.sample(candidates, min(num_pairs, len(candidates))):
+        pairs.append(
+            {
+                "char_span_start": str(min(int(source["start"]), int(target["start"]))),
+                "char_span_end": str(max(int(source["end"]), int(target["end"]))),
+                "tlinkID": f"TL{source['id']}{target['id']}",
+                "fromID": source["id"],
+                "fromText": source["text"],
+                "fromStart": source["start"],
+                "fromEnd": source["end"],
+                "toID": target["id"],
+                "toText": target["text"],
+                "toStart": target["start"],
+                "toEnd": target["end"],
+            }
+        )
+    return pairs
+
+
+def generate_corpus(
+    output_path: str,
+    num_docs: int = 20,
+    pairs_per_doc: int = 10,
+    sentences_per_doc: int = 40,
+    events_per_doc: int = 12,
+    seed: int = 0,
+) -> Dict[str, str]:
+    """
+    Write a synthetic corpus in the layout main.py reads: the xml notes in
+    output_path/data (including 31.xml, which main.py leaves out) and their
+    candidate pairs in output_path/gold_and_candidate_pairs.xml
+    :return: The data_path and the project path to give to main.py
+    """
+    rng = random.Random(seed)
+    data_path = os.path.join(output_path, "data")
+    os.makedirs(data_path, exist_ok=True)
+
+    root = Element("Root")
+    doc_names = [str(i) for i in range(1, num_docs + 1)]
+    if "31" not in doc_names:
+        doc_names.append("31")
+    for doc_name in doc_names:
+        report = make_report(rng, sentences_per_doc, events_per_doc)
+        write_report(report, os.path.join(data_path, f"{doc_name}.xml"))
+        report_elem = SubElement(root, "Report", {"filename": f"{doc_name}.xml"})
+        for pair in make_pairs(rng, report, pairs_per_doc):
+            SubElement(report_elem, "Pair", pair)
+    ElementTree(root).write(os.path.join(output_path, "gold_and_candidate_pairs.xml"))
+    return {"data_path": data_path, "path": output_path}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic i2b2-shaped corpus and pairs file for the benchmarks"
+    )
+    parser.add_argument("--output_path", type=str, required=True)
+    parser.add_argument("--num_docs", type=int, default=20)
+    parser.add_argument("--pairs_per_doc", type=int, default=10)
+    parser.add_argument("--sentences_per_doc", type=int, default=40)
+    parser.add_argument("--events_per_doc", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    paths = generate_corpus(
+        args.output_path,
+        num_docs=args.num_docs,
+        pairs_per_doc=args.pairs_per_doc,
+        sentences_per_doc=args.sentences_per_doc,
+        events_per_doc=args.events_per_doc,
+        seed=args.seed,
+    )
+    print(f"--data_path {paths['data_path']} --path {paths['path']}")
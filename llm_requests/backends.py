@@ -0,0 +1,512 @@
+import asyncio
+import re
+import time
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+import openai
+from huggingface_hub import AsyncInferenceClient, InferenceClient
+
+from llm_requests.rate_limit import CHARS_PER_TOKEN
+from llm_requests.scheduling import route
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 600.0
+
+# Registry of the available backends, filled by the register_backend decorator
+BACKENDS: Dict[str, type] = {}
+
+
+def register_backend(name: str) -> Callable:
+    def decorator(cls):
+        cls.name = name
+        BACKENDS[name] = cls
+        return cls
+
+    return decorator
+
+
+def build_llama_prompt(messages) -> str:
+    prompt = f"""[INST]<<SYS>><</SYS>>{messages[0]['content']}[/INST]"""
+    for message in messages[1:]:
+        if message["role"] == "assistant":
+            prompt += f"""{message['content']}"""
+        else:
+            prompt += f"""[INST]{message['content']}[/INST]"""
+    return prompt
+
+
+# Templates for the backends that take a plain text prompt instead of chat messages
+CHAT_TEMPLATES = {
+    "llama-2": build_llama_prompt,
+}
+
+
+class Backend:
+    """
+    A model server: its endpoint(s), how it formats the conversation, how many
+    concurrent requests it should receive and whether it accepts batch jobs.
+    """
+
+    name: str = None
+    # None: the server applies the chat template to the messages itself
+    chat_template: Optional[str] = None
+    # None: no limit besides the ones of the run
+    max_concurrency: Optional[int] = None
+    # Whether the backend can run an offline batch of requests (JSONL file)
+    supports_batch_jobs: bool = False
+
+    def __init__(self, hyperparams: Dict):
+        self.hyperparams = hyperparams
+        self.model = hyperparams["model"]
+        self.temp = hyperparams["temp"]
+        self.pool_size = hyperparams.get("pool_size") or DEFAULT_POOL_SIZE
+        self.timeout = hyperparams.get("timeout") or DEFAULT_TIMEOUT
+        if hyperparams.get("max_concurrency"):
+            self.max_concurrency = hyperparams["max_concurrency"]
+        self.endpoints = self.get_endpoints()
+
+    def get_endpoints(self) -> List[Optional[str]]:
+        # several replicas of the same server can be given separated by commas
+        return [url.strip() for url in self.hyperparams["url"].split(",")]
+
+    def select_endpoint(self, route_key: Optional[str] = None) -> Optional[str]:
+        """Endpoint for a request, requests with the same route key go to the same one"""
+        return self.endpoints[route(route_key, self.endpoints)]
+
+    def alternate_endpoint(self, endpoint: Optional[str]) -> Optional[str]:
+        """Another endpoint than the given one, if the backend has several"""
+        index = self.endpoints.index(endpoint) if endpoint in self.endpoints else -1
+        return self.endpoints[(index + 1) % len(self.endpoints)]
+
+    def health_url(self, endpoint: Optional[str]) -> Optional[str]:
+        """URL that answers with a success status while the endpoint is up (None: not probed)"""
+        return None
+
+    def format_prompt(self, messages: List[Dict]) -> str:
+        return CHAT_TEMPLATES[self.chat_template](messages)
+
+    def create_client(self, endpoint: Optional[str], pool_size: int = None):
+        raise NotImplementedError
+
+    def create_async_client(self, endpoint: Optional[str], pool_size: int = None):
+        raise NotImplementedError
+
+    def complete(self, client, messages: List[Dict]) -> Tuple[str, Optional[Dict]]:
+        """
+        :return: The generated text and the token usage reported by the server
+        (prompt_tokens, completion_tokens, total_tokens), if any
+        """
+        raise NotImplementedError
+
+    async def complete_async(
+        self, client, messages: List[Dict]
+    ) -> Tuple[str, Optional[Dict]]:
+        raise NotImplementedError
+
+    def stream(
+        self, client, messages: List[Dict], usage: Optional[Dict] = None
+    ) -> Iterator[str]:
+        """
+        Generate the response piece by piece, closing the generator cancels it
+        :param usage: Filled with the token usage if the server reports it at the end
+        of the stream
+        """
+        raise NotImplementedError
+
+    def stream_async(
+        self, client, messages: List[Dict], usage: Optional[Dict] = None
+    ) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+    @staticmethod
+    def estimate_prompt_tokens(messages: List[Dict]) -> int:
+        """Prompt tokens of a request whose server does not report them"""
+        return sum(len(message["content"]) for message in messages) // CHARS_PER_TOKEN
+
+    @classmethod
+    def streamed_usage(cls, messages: List[Dict], num_pieces: int, usage: Dict) -> Dict:
+        """
+        The usage reported at the end of the stream, or an estimate when the stream
+        was cancelled before (or the server does not report it)
+        """
+        if usage.get("total_tokens") is not None:
+            return usage
+        # servers stream (about) one token per piece
+        prompt_tokens = cls.estimate_prompt_tokens(messages)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": num_pieces,
+            "total_tokens": prompt_tokens + num_pieces,
+        }
+
+    def complete_until(
+        self, client, messages: List[Dict], stop_when: Callable[[str], bool]
+    ) -> Tuple[str, Optional[Dict], bool]:
+        """
+        Stream the response and cancel the generation as soon as stop_when holds for
+        the text received so far.
+        :return: The generated text, the token usage and whether it was stopped early
+        """
+        response_text, num_pieces, stopped = "", 0, False
+        usage = {}
+        pieces = self.stream(client, messages, usage)
+        try:
+            for piece in pieces:
+                response_text += piece
+                num_pieces += 1
+                if stop_when(response_text):
+                    stopped = True
+                    break
+        finally:
+            pieces.close()
+        return response_text, self.streamed_usage(messages, num_pieces, usage), stopped
+
+    async def complete_until_async(
+        self, client, messages: List[Dict], stop_when: Callable[[str], bool]
+    ) -> Tuple[str, Optional[Dict], bool]:
+        response_text, num_pieces, stopped = "", 0, False
+        usage = {}
+        pieces = self.stream_async(client, messages, usage)
+        try:
+            async for piece in pieces:
+                response_text += piece
+                num_pieces += 1
+                if stop_when(response_text):
+                    stopped = True
+                    break
+        finally:
+            await pieces.aclose()
+        return response_text, self.streamed_usage(messages, num_pieces, usage), stopped
+
+    def close_client(self, client):
+        close = getattr(client, "close", None)
+        if close is not None:
+            close()
+
+
+@register_backend("openai")
+class OpenAIBackend(Backend):
+    """Hosted OpenAI models"""
+
+    supports_batch_jobs = True
+
+    def get_endpoints(self) -> List[Optional[str]]:
+        # the client picks the hosted API URL and the api key from the environment
+        return [None]
+
+    def get_client_kwargs(self, endpoint: Optional[str]) -> Dict:
+        return {}
+
+    def get_max_retries(self) -> int:
+        # With a request/token budget the 429s must reach the shared scheduler
+        # instead of being retried by each client on its own, and with several
+        # replicas a failed request is retried on another one by the load balancer
+        if self.hyperparams.get("rpm") or self.hyperparams.get("tpm"):
+            return 0
+        if len(self.endpoints) > 1:
+            return 0
+        return 2
+
+    def create_client(self, endpoint: Optional[str], pool_size: int = None):
+        pool_size = pool_size or self.pool_size
+        http_client = openai.DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=pool_size, max_keepalive_connections=pool_size
+            ),
+            timeout=self.timeout,
+        )
+        return openai.Client(
+            http_client=http_client,
+            max_retries=self.get_max_retries(),
+            **self.get_client_kwargs(endpoint),
+        )
+
+    def create_async_client(self, endpoint: Optional[str], pool_size: int = None):
+        pool_size = pool_size or self.pool_size
+        http_client = openai.DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=pool_size, max_keepalive_connections=pool_size
+            ),
+            timeout=self.timeout,
+        )
+        return openai.AsyncClient(
+            http_client=http_client,
+            max_retries=self.get_max_retries(),
+            **self.get_client_kwargs(endpoint),
+        )
+
+    def parse_response(self, response) -> Tuple[str, Optional[Dict]]:
+        usage = None
+        if response.usage is not None:
+            usage = {
+                "prompt_tokens": response.usage.prompt_tokens,
+                "completion_tokens": response.usage.completion_tokens,
+                "total_tokens": response.usage.total_tokens,
+            }
+        return response.choices[0].message.content, usage
+
+    def complete(self, client, messages: List[Dict]) -> Tuple[str, Optional[Dict]]:
+        response = client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=self.temp,
+        )
+        return self.parse_response(response)
+
+    async def complete_async(
+        self, client, messages: List[Dict]
+    ) -> Tuple[str, Optional[Dict]]:
+        response = await client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=self.temp,
+        )
+        return self.parse_response(response)
+
+    @staticmethod
+    def read_usage(chunk, usage: Optional[Dict]):
+        # with include_usage the last chunk has the usage of the request and no choices
+        if usage is not None and getattr(chunk, "usage", None) is not None:
+            usage.update(
+                prompt_tokens=chunk.usage.prompt_tokens,
+                completion_tokens=chunk.usage.completion_tokens,
+                total_tokens=chunk.usage.total_tokens,
+            )
+
+    def stream(
+        self, client, messages: List[Dict], usage: Optional[Dict] = None
+    ) -> Iterator[str]:
+        response = client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=self.temp,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        try:
+            for chunk in response:
+                self.read_usage(chunk, usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # closing the connection aborts the generation on the server
+            response.close()
+
+    async def stream_async(
+        self, client, messages: List[Dict], usage: Optional[Dict] = None
+    ) -> AsyncIterator[str]:
+        response = await client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=self.temp,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        try:
+            async for chunk in response:
+                self.read_usage(chunk, usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await response.close()
+
+
+@register_backend("openai-compatible")
+class OpenAICompatibleBackend(OpenAIBackend):
+    """Self-hosted servers with an OpenAI compatible API, e.g. vLLM"""
+
+    max_concurrency = 256
+
+    def get_endpoints(self) -> List[Optional[str]]:
+        endpoints = []
+        for url in Backend.get_endpoints(self):
+            url = url.rstrip("/")
+            if not url.endswith("/v1"):
+                url += "/v1"
+            endpoints.append(url)
+        return endpoints
+
+    def get_client_kwargs(self, endpoint: Optional[str]) -> Dict:
+        return {"base_url": endpoint, "api_key": "EMPTY"}
+
+    def health_url(self, endpoint: Optional[str]) -> Optional[str]:
+        # vLLM serves /health next to the /v1 API
+        return endpoint[: -len("/v1")] + "/health"
+
+
+@register_backend("tgi")
+class TGIBackend(Backend):
+    """Text Generation Inference servers, which take the prompt as plain text"""
+
+    chat_template = "llama-2"
+    max_concurrency = 128
+    max_new_tokens = 600
+
+    def health_url(self, endpoint: Optional[str]) -> Optional[str]:
+        return endpoint.rstrip("/") + "/health"
+
+    def create_client(self, endpoint: Optional[str], pool_size: int = None):
+        return InferenceClient(model=endpoint, timeout=self.timeout)
+
+    def create_async_client(self, endpoint: Optional[str], pool_size: int = None):
+        return AsyncInferenceClient(model=endpoint, timeout=self.timeout)
+
+    def parse_response(self, response, messages: List[Dict]) -> Tuple[str, Optional[Dict]]:
+        # TGI reports only the generated tokens (the prompt ones with
+        # decoder_input_details, which sends back every token of the prompt)
+        usage = None
+        if response.details is not None:
+            prompt_tokens = len(response.details.prefill or []) or self.estimate_prompt_tokens(
+                messages
+            )
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": response.details.generated_tokens,
+                "total_tokens": prompt_tokens + response.details.generated_tokens,
+            }
+        return response.generated_text, usage
+
+    def complete(self, client, messages: List[Dict]) -> Tuple[str, Optional[Dict]]:
+        response = client.text_generation(
+            prompt=self.format_prompt(messages),
+            max_new_tokens=self.max_new_tokens,
+            details=True,
+            temperature=self.temp,
+            do_sample=True,
+        )
+        return self.parse_response(response, messages)
+
+    async def complete_async(
+        self, client, messages: List[Dict]
+    ) -> Tuple[str, Optional[Dict]]:
+        response = await client.text_generation(
+            prompt=self.format_prompt(messages),
+            max_new_tokens=self.max_new_tokens,
+            details=True,
+            temperature=self.temp,
+            do_sample=True,
+        )
+        return self.parse_response(response, messages)
+
+    def stream(
+        self, client, messages: List[Dict], usage: Optional[Dict] = None
+    ) -> Iterator[str]:
+        tokens = client.text_generation(
+            prompt=self.format_prompt(messages),
+            max_new_tokens=self.max_new_tokens,
+            temperature=self.temp,
+            do_sample=True,
+            stream=True,
+        )
+        try:
+            yield from tokens
+        finally:
+            close = getattr(tokens, "close", None)
+            if close is not None:
+                close()
+
+    async def stream_async(
+        self, client, messages: List[Dict], usage: Optional[Dict] = None
+    ) -> AsyncIterator[str]:
+        tokens = await client.text_generation(
+            prompt=self.format_prompt(messages),
+            max_new_tokens=self.max_new_tokens,
+            temperature=self.temp,
+            do_sample=True,
+            stream=True,
+        )
+        try:
+            async for token in tokens:
+                yield token
+        finally:
+            aclose = getattr(tokens, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    def close_client(self, client):
+        pass
+
+
+@register_backend("stub")
+class StubBackend(Backend):
+    """
+    Local backend that answers "No" to every question without any network call,
+    for testing the pipeline offline. The hyperparameter stub_latency adds a delay
+    (in seconds) to every response.
+    """
+
+    def get_endpoints(self) -> List[Optional[str]]:
+        return ["stub"]
+
+    def create_client(self, endpoint: Optional[str], pool_size: int = None):
+        return None
+
+    def create_async_client(self, endpoint: Optional[str], pool_size: int = None):
+        return None
+
+    def respond(self, messages: List[Dict]) -> Tuple[str, Optional[Dict]]:
+        question_ids = re.findall(r"(P\d+-)?Q(\d+): ", messages[-1]["content"])
+        if question_ids:
+            response_text = "\n".join(
+                f"{pair_id}A{q_id}: no" for pair_id, q_id in question_ids
+            )
+        else:
+            response_text = "No"
+        # approximate usage, 4 characters per token
+        prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+        completion_tokens = len(response_text) // 4 + 1
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        return response_text, usage
+
+    def complete(self, client, messages: List[Dict]) -> Tuple[str, Optional[Dict]]:
+        time.sleep(self.hyperparams.get("stub_latency") or 0)
+        return self.respond(messages)
+
+    async def complete_async(
+        self, client, messages: List[Dict]
+    ) -> Tuple[str, Optional[Dict]]:
+        await asyncio.sleep(self.hyperparams.get("stub_latency") or 0)
+        return self.respond(messages)
+
+    def stream(
+        self, client, messages: List[Dict], usage: Optional[Dict] = None
+    ) -> Iterator[str]:
+        time.sleep(self.hyperparams.get("stub_latency") or 0)
+        response_text, response_usage = self.respond(messages)
+        if usage is not None:
+            usage.update(response_usage)
+        for i in range(0, len(response_text), 4):
+            yield response_text[i : i + 4]
+
+    async def stream_async(
+        self, client, messages: List[Dict], usage: Optional[Dict] = None
+    ) -> AsyncIterator[str]:
+        await asyncio.sleep(self.hyperparams.get("stub_latency") or 0)
+        response_text, response_usage = self.respond(messages)
+        if usage is not None:
+            usage.update(response_usage)
+        for i in range(0, len(response_text), 4):
+            yield response_text[i : i + 4]
+
+
+def infer_backend(model: str) -> str:
+    """Backend of the models used in the paper, when none is given explicitly"""
+    if model in ["meta-llama/Llama-2-70b-chat-hf"]:
+        return "tgi"
+    if model.startswith("gpt-"):
+        return "openai"
+    return "openai-compatible"
+
+
+def create_backend(hyperparams: Dict) -> Backend:
+    name = hyperparams.get("backend") or infer_backend(hyperparams["model"])
+    if name not in BACKENDS:
+        raise ValueError(
+            f"Unknown backend {name}, available backends: {list(BACKENDS.keys())}"
+        )
+    return BACKENDS[name](hyperparams)
@@ -0,0 +1,154 @@
+import threading
+import time
+import urllib.request
+from typing import Callable, Dict, List, Optional, Set
+
+import httpx
+import openai
+
+# Consecutive failures after which an endpoint is ejected (circuit opened)
+FAILURE_THRESHOLD = 3
+# Seconds an ejected endpoint gets no requests before it is tried again
+EJECT_SECONDS = 30.0
+# An endpoint can have this many more requests in flight than the least loaded one
+# and still get the requests routed to it (to keep the prefix cache locality)
+STICKY_SLACK = 2
+
+
+def is_endpoint_failure(ex: Exception) -> bool:
+    """Whether an exception means the endpoint is down or failing (not a bad request)"""
+    status_code = getattr(getattr(ex, "response", None), "status_code", None)
+    if status_code is not None:
+        return status_code >= 500
+    return isinstance(
+        ex,
+        (
+            openai.APIConnectionError,
+            httpx.TransportError,
+            ConnectionError,
+            TimeoutError,
+            OSError,
+        ),
+    )
+
+
+class LoadBalancer:
+    """
+    Client-side balancer over the replicas of a backend: requests go to the healthy
+    endpoint with the least outstanding requests, endpoints that keep failing are
+    ejected for a while (circuit breaker), and an optional background thread probes
+    their health URL. The state is per process.
+    """
+
+    def __init__(
+        self,
+        endpoints: List[Optional[str]],
+        health_url: Callable[[Optional[str]], Optional[str]] = None,
+        failure_threshold: int = FAILURE_THRESHOLD,
+        eject_seconds: float = EJECT_SECONDS,
+    ):
+        self.endpoints = endpoints
+        self.health_url = health_url
+        self.failure_threshold = failure_threshold
+        self.eject_seconds = eject_seconds
+        self.lock = threading.Lock()
+        self.outstanding = {endpoint: 0 for endpoint in endpoints}
+        self.failures = {endpoint: 0 for endpoint in endpoints}
+        self.ejected_until = {endpoint: 0.0 for endpoint in endpoints}
+        self.prober = None
+
+    def is_healthy(self, endpoint: Optional[str], now: float) -> bool:
+        return self.ejected_until[endpoint] <= now
+
+    def acquire(
+        self, preferred: Optional[str] = None, exclude: Set[Optional[str]] = None
+    ) -> Optional[str]:
+        """
+        :param preferred: Endpoint to use if it is healthy and not overloaded
+        :param exclude: Endpoints that already failed for this request
+        :return: The endpoint for the request, counted as outstanding until release
+        """
+        with self.lock:
+            now = time.time()
+            candidates = [
+                endpoint
+                for endpoint in self.endpoints
+                if self.is_healthy(endpoint, now) and endpoint not in (exclude or ())
+            ]
+            if not candidates:
+                # everything is ejected: fail open on the endpoint that returns first
+                candidates = [
+                    min(
+                        (e for e in self.endpoints if e not in (exclude or ())),
+                        key=lambda e: self.ejected_until[e],
+                        default=self.endpoints[0],
+                    )
+                ]
+
+            least_loaded = min(candidates, key=lambda e: self.outstanding[e])
+            endpoint = least_loaded
+            if (
+                preferred in candidates
+                and self.outstanding[preferred]
+                <= self.outstanding[least_loaded] + STICKY_SLACK
+            ):
+                endpoint = preferred
+            self.outstanding[endpoint] += 1
+            return endpoint
+
+    def release(self, endpoint: Optional[str], failed: bool = False):
+        with self.lock:
+            self.outstanding[endpoint] -= 1
+            if failed:
+                self.record_failure(endpoint)
+            else:
+                self.failures[endpoint] = 0
+
+    def record_failure(self, endpoint: Optional[str]):
+        self.failures[endpoint] += 1
+        if self.failures[endpoint] >= self.failure_threshold:
+            self.ejected_until[endpoint] = time.time() + self.eject_seconds
+
+    def probe(self, timeout: float = 5.0):
+        """Check the health URL of every endpoint and eject the failing ones"""
+        for endpoint in self.endpoints:
+            url = self.health_url(endpoint) if self.health_url else None
+            if url is None:
+                continue
+            try:
+                with urllib.request.urlopen(url, timeout=timeout) as response:
+                    healthy = response.status < 500
+            except Exception:
+                healthy = False
+            with self.lock:
+                if healthy:
+                    # close the circuit of a recovered endpoint right away
+                    self.failures[endpoint] = 0
+                    self.ejected_until[endpoint] = 0.0
+                else:
+                    self.failures[endpoint] = max(
+                        self.failures[endpoint], self.failure_threshold - 1
+                    )
+                    self.record_failure(endpoint)
+
+    def start_probing(self, interval: float):
+        """Probe the endpoints every `interval` seconds in a daemon thread"""
+
+        def run():
+            while True:
+                self.probe()
+                time.sleep(interval)
+
+        self.prober = threading.Thread(target=run, daemon=True)
+        self.prober.start()
+
+    def status(self) -> Dict:
+        now = time.time()
+        return {
+            str(endpoint): {
+                "outstanding": self.outstanding[endpoint],
+                "failures": self.failures[endpoint],
+                "healthy": self.is_healthy(endpoint, now),
+            }
+            for endpoint in self.endpoints
+        }
@@ -0,0 +1,93 @@
+import json
+from typing import Dict, List
+
+from llm_requests.backends import create_backend
+from llm_requests.metrics import new_request_stats, record_usage
+from llm_requests.store import ResultStore
+from llm_requests.strategies.common import is_done, load_results, record_error
+
+import llm_requests.strategies.batchqa as batchqa
+
+BATCH_URL = "/v1/chat/completions"
+
+
+def check_batch_support(strategy: str, api_hyperparams: Dict):
+    if strategy != "batchqa":
+        # the cot questions depend on the previous responses of the conversation
+        raise ValueError("Batch jobs are only supported for the batchqa strategy")
+    backend = create_backend(api_hyperparams)
+    if not backend.supports_batch_jobs:
+        raise ValueError(f"The {backend.name} backend does not support batch jobs")
+
+
+def export_batch(prompts: List[Dict], api_hyperparams: Dict, batch_file: str) -> int:
+    """
+    Write the requests of the queries in the JSONL format of the OpenAI batch API
+    (also read by the vLLM offline batch runner), with the unique_id as custom_id.
+    :return: The number of exported requests
+    """
+    num_requests = 0
+    with open(batch_file, "w") as file:
+        for query in prompts:
+            request = {
+                "custom_id": query["unique_id"],
+                "method": "POST",
+                "url": BATCH_URL,
+                "body": {
+                    "model": api_hyperparams["model"],
+                    "messages": batchqa.build_messages(query),
+                    "temperature": api_hyperparams["temp"],
+                },
+            }
+            file.write(json.dumps(request) + "\n")
+            num_requests += 1
+    return num_requests
+
+
+def import_batch(
+    prompts: List[Dict], batch_results_file: str, store: ResultStore, max_tries: int = None
+) -> List[Dict]:
+    """
+    Parse the output JSONL of a batch job into the result records of the queries,
+    as process_query would have saved them.
+    :return: The result records of the queries found in the batch output
+    """
+    queries = {query["unique_id"]: query for query in prompts}
+    all_results = []
+
+    with open(batch_results_file, "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            output = json.loads(line)
+            query = queries.get(output["custom_id"])
+            if query is None:
+                print(f"Unknown custom_id {output['custom_id']} in the batch output")
+                continue
+
+            results = load_results(query, store)
+            if is_done(results, max_tries):
+                all_results.append(results)
+                continue
+
+            try:
+                response = output.get("response") or {}
+                if output.get("error") or response.get("status_code", 200) != 200:
+                    raise ValueError(
+                        f"Batch request failed: {output.get('error') or response.get('body')}"
+                    )
+                body = response["body"]
+                stats = new_request_stats()
+                record_usage(stats, body.get("usage"))
+                results.setdefault("requests", []).append(stats)
+
+                response_text = body["choices"][0]["message"]["content"]
+                batchqa.record_response(
+                    results, query, batchqa.build_messages(query), response_text
+                )
+            except Exception as ex:
+                record_error(results, ex)
+
+            all_results.append(batchqa.save_results(results, store))
+
+    return all_results
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_MAX_ENTRIES = 1000000
+# Eviction is checked every this many insertions
+EVICTION_INTERVAL = 1000
+
+# Cache of the current process, opened lazily by get_cache
+_CACHE = None
+
+
+def cache_key(backend: str, model: str, temperature: float, messages: List[Dict]) -> str:
+    """Hash of everything that determines the response of a request"""
+    content = json.dumps(
+        [backend, model, temperature, messages], sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent cache of responses keyed by the hash of the request, shared by all
+    runs, strategies and save paths that point to the same file. When it grows
+    beyond max_entries, the least recently used responses are evicted.
+    """
+
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.num_inserts = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # several worker processes share the file, and the threads of a worker
+        # share the connection
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT, usage TEXT, last_access REAL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)"
+        )
+        self.connection.commit()
+
+    def get(self, key: str) -> Optional[Tuple[str, Optional[Dict]]]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT response, usage FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key)
+                )
+        return row[0], json.loads(row[1]) if row[1] else None
+
+    def put(self, key: str, response_text: str, usage: Optional[Dict] = None):
+        with self.lock:
+            with self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                    (key, response_text, json.dumps(usage) if usage else None, time.time()),
+                )
+            self.num_inserts += 1
+            if self.num_inserts % EVICTION_INTERVAL == 0:
+                self.evict()
+
+    def evict(self):
+        """Remove the least recently used responses beyond max_entries"""
+        with self.lock:
+            (num_entries,) = self.connection.execute(
+                "SELECT COUNT(*) FROM responses"
+            ).fetchone()
+            if num_entries <= self.max_entries:
+                return
+            with self.connection:
+                self.connection.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY last_access LIMIT ?)",
+                    (num_entries - self.max_entries,),
+                )
+
+    def close(self):
+        self.connection.close()
+
+
+def get_cache(hyperparams: Dict) -> Optional[ResponseCache]:
+    """
+    :return: The response cache of the current process, or None if the run has no
+    cache_path
+    """
+    global _CACHE
+    if not hyperparams.get("cache_path"):
+        return None
+    # sqlite connections must not be shared with forked workers
+    if _CACHE is None or _CACHE[0] != os.getpid() or _CACHE[1].path != hyperparams["cache_path"]:
+        cache = ResponseCache(
+            hyperparams["cache_path"],
+            max_entries=hyperparams.get("cache_max_entries") or DEFAULT_MAX_ENTRIES,
+        )
+        _CACHE = (os.getpid(), cache)
+    return _CACHE[1]
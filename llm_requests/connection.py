@@ -1,54 +1,360 @@
-from typing import Dict
+import asyncio
+import json
+import time
+from functools import partial
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 # import backoff  # for exponential backoff -> to avoid RateLimitError
-import openai
-from huggingface_hub import InferenceClient
 
+from llm_requests.backends import Backend, create_backend
+from llm_requests.balancer import LoadBalancer, is_endpoint_failure
+from llm_requests.cache import cache_key, get_cache
+from llm_requests.hedging import get_hedge_delay, run_hedged, run_hedged_async
+from llm_requests.metrics import new_request_stats, record_usage
+from llm_requests.rate_limit import estimate_tokens, get_rate_limiter, get_retry_after
 
-def send_llama_prompt(messages, hyperparams: Dict):
 
-    prompt = f"""[INST]<<SYS>><</SYS>>{messages[0]['content']}[/INST]"""
-    for message in messages[1:]:
-        if message["role"] == "assistant":
-            prompt += f"""{message['content']}"""
+# Per-process pool of clients keyed by (hyperparameters, endpoint), so that every
+# worker keeps its keep-alive connections instead of reconnecting on each request
+_CLIENTS: Dict[Tuple, Tuple[Backend, object]] = {}
+# Same for the asyncio engine, which runs all requests of the process in one event loop
+_ASYNC_CLIENTS: Dict[Tuple, Tuple[Backend, object]] = {}
+# Backends of the current process, keyed by their hyperparameters
+_BACKENDS: Dict[str, Backend] = {}
+# Load balancers over the endpoints of the backends, with the same keys
+_BALANCERS: Dict[str, LoadBalancer] = {}
+
+# Rate limit (429) errors are waited out and retried without counting as a failed try
+MAX_RATE_LIMIT_RETRIES = 5
+
+
+def hyperparams_key(hyperparams: Dict) -> str:
+    """
+    Key of the backend of a run: the configurations of a sweep can share a model
+    and url but not its temperature, timeout, pool size...
+    """
+    return json.dumps(hyperparams, sort_keys=True, default=str)
+
+
+def get_backend(hyperparams: Dict) -> Backend:
+    key = hyperparams_key(hyperparams)
+    if key not in _BACKENDS:
+        _BACKENDS[key] = create_backend(hyperparams)
+    return _BACKENDS[key]
+
+
+def get_balancer(hyperparams: Dict) -> LoadBalancer:
+    key = hyperparams_key(hyperparams)
+    if key not in _BALANCERS:
+        backend = get_backend(hyperparams)
+        balancer = LoadBalancer(backend.endpoints, health_url=backend.health_url)
+        if hyperparams.get("health_interval") and len(backend.endpoints) > 1:
+            balancer.start_probing(hyperparams["health_interval"])
+        _BALANCERS[key] = balancer
+    return _BALANCERS[key]
+
+
+def get_client(hyperparams: Dict, endpoint: Optional[str] = None):
+    """
+    :param hyperparams: The API hyperparameters of the run
+    :param endpoint: The endpoint of the backend to connect to (default: its first one)
+    :return: The pooled client of the current process for the backend of the run
+    """
+    backend = get_backend(hyperparams)
+    endpoint = endpoint or backend.endpoints[0]
+    key = (hyperparams_key(hyperparams), endpoint)
+    if key not in _CLIENTS:
+        _CLIENTS[key] = backend, backend.create_client(endpoint)
+    return _CLIENTS[key][1]
+
+
+def get_async_client(hyperparams: Dict, endpoint: Optional[str] = None):
+    """
+    :param hyperparams: The API hyperparameters of the run
+    :param endpoint: The endpoint of the backend to connect to (default: its first one)
+    :return: The pooled asyncio client of the current process for the backend of the run
+    """
+    backend = get_backend(hyperparams)
+    endpoint = endpoint or backend.endpoints[0]
+    key = (hyperparams_key(hyperparams), endpoint)
+    if key not in _ASYNC_CLIENTS:
+        # All in-flight requests share this client, so let it hold as many connections
+        pool_size = max(backend.pool_size, hyperparams.get("max_in_flight") or 0)
+        _ASYNC_CLIENTS[key] = backend, backend.create_async_client(
+            endpoint, pool_size=pool_size
+        )
+    return _ASYNC_CLIENTS[key][1]
+
+
+def init_clients():
+    """
+    Initializer for the worker processes: drop any client inherited from the parent
+    process (its sockets must not be shared after fork). The fresh ones are opened
+    by the first requests, so that a client that cannot be created (e.g. no API
+    key) fails the queries instead of the initializer, which the pool would rerun
+    forever.
+    """
+    _CLIENTS.clear()
+    _ASYNC_CLIENTS.clear()
+    _BACKENDS.clear()
+    _BALANCERS.clear()
+
+
+def close_clients():
+    """Close the connections of the synchronous clients of the current process"""
+    for backend, client in _CLIENTS.values():
+        backend.close_client(client)
+    _CLIENTS.clear()
+
+
+def release_failed(
+    balancer: LoadBalancer,
+    endpoint: Optional[str],
+    failed_endpoints: Optional[Set[Optional[str]]],
+    ex: Exception,
+):
+    """Release the endpoint of a failed request, excluding it from the next tries if it is down"""
+    failed = is_endpoint_failure(ex)
+    balancer.release(endpoint, failed=failed)
+    if failed and failed_endpoints is not None:
+        failed_endpoints.add(endpoint)
+
+
+def request_completion(
+    messages,
+    hyperparams: Dict,
+    preferred_endpoint: Optional[str] = None,
+    failed_endpoints: Set[Optional[str]] = None,
+    stop_when: Optional[Callable[[str], bool]] = None,
+):
+    """
+    Send the request to the endpoint picked by the load balancer.
+    :param preferred_endpoint: Endpoint to use if it is healthy and not overloaded
+    :param failed_endpoints: Endpoints not to use, the endpoint is added to it if it fails
+    :return: The response text, its token usage and whether the generation was
+    stopped early (only when streaming is enabled)
+    """
+    backend = get_backend(hyperparams)
+    balancer = get_balancer(hyperparams)
+    endpoint = balancer.acquire(preferred_endpoint, exclude=failed_endpoints)
+    try:
+        client = get_client(hyperparams, endpoint)
+        if hyperparams.get("stream") and stop_when is not None:
+            result = backend.complete_until(client, messages, stop_when)
+        else:
+            response_text, usage = backend.complete(client, messages)
+            result = response_text, usage, False
+    except Exception as ex:
+        release_failed(balancer, endpoint, failed_endpoints, ex)
+        raise
+    balancer.release(endpoint)
+    return result
+
+
+async def request_completion_async(
+    messages,
+    hyperparams: Dict,
+    preferred_endpoint: Optional[str] = None,
+    failed_endpoints: Set[Optional[str]] = None,
+    stop_when: Optional[Callable[[str], bool]] = None,
+):
+    backend = get_backend(hyperparams)
+    balancer = get_balancer(hyperparams)
+    endpoint = balancer.acquire(preferred_endpoint, exclude=failed_endpoints)
+    try:
+        client = get_async_client(hyperparams, endpoint)
+        if hyperparams.get("stream") and stop_when is not None:
+            result = await backend.complete_until_async(client, messages, stop_when)
+        else:
+            response_text, usage = await backend.complete_async(client, messages)
+            result = response_text, usage, False
+    except asyncio.CancelledError:
+        # lost a hedging race
+        balancer.release(endpoint)
+        raise
+    except Exception as ex:
+        release_failed(balancer, endpoint, failed_endpoints, ex)
+        raise
+    balancer.release(endpoint)
+    return result
+
+
+def lookup_cache(messages, hyperparams: Dict, use_cache: bool = True):
+    """
+    :param use_cache: Whether to look the request up, the cache is returned anyway
+    so that the new response replaces the cached one
+    :return: The response cache of the run (or None), the key of the request and
+    the cached response text, if any
+    """
+    cache = get_cache(hyperparams)
+    if cache is None:
+        return None, None, None
+    backend = get_backend(hyperparams)
+    key = cache_key(backend.name, backend.model, backend.temp, messages)
+    cached = cache.get(key) if use_cache else None
+    return cache, key, cached[0] if cached is not None else None
+
+
+class PromptRequest:
+    """
+    The state of a request across its tries (rate limit waits and failovers to
+    another replica), shared by send_prompt and send_prompt_async which only
+    differ in how they wait and send
+    """
+
+    def __init__(
+        self,
+        messages,
+        hyperparams: Dict,
+        request_log: Optional[List[Dict]],
+        route_key: Optional[str],
+        stop_when: Optional[Callable[[str], bool]],
+        use_cache: bool,
+    ):
+        self.messages = messages
+        self.hyperparams = hyperparams
+        self.request_log = request_log
+        self.stop_when = stop_when
+        self.stats = new_request_stats()
+        self.cache, self.key, self.cached_text = lookup_cache(messages, hyperparams, use_cache)
+        # a duplicate request, if hedged, goes to another replica if there is one
+        self.backend = get_backend(hyperparams)
+        self.endpoint = self.backend.select_endpoint(route_key)
+        self.hedge_endpoint = self.backend.alternate_endpoint(self.endpoint)
+        self.failed_endpoints = set()
+        self.limiter = get_rate_limiter(hyperparams_key(hyperparams))
+        self.request_start = None
+
+    def log(self):
+        if self.request_log is not None:
+            self.request_log.append(self.stats)
+
+    def from_cache(self) -> str:
+        self.stats["cached"] = True
+        self.log()
+        return self.cached_text
+
+    def start(self, queue_wait: float):
+        """A new try, after waiting `queue_wait` seconds for the rate limiter"""
+        self.stats["queue_wait"] += queue_wait
+        self.request_start = time.perf_counter()
+
+    def hedged_requests(self, complete: Callable) -> Tuple[Callable, Callable]:
+        """The primary and the hedge request of a try, sent with `complete`"""
+        return tuple(
+            partial(
+                complete,
+                self.messages,
+                self.hyperparams,
+                endpoint,
+                self.failed_endpoints,
+                self.stop_when,
+            )
+            for endpoint in [self.endpoint, self.hedge_endpoint]
+        )
+
+    def retry_wait(self, ex: Exception) -> Optional[float]:
+        """:return: The seconds to wait before trying the request again, None to give up"""
+        self.stats["latency"] += time.perf_counter() - self.request_start
+        retry_after = get_retry_after(ex)
+        if retry_after is not None and self.stats["retries"] < MAX_RATE_LIMIT_RETRIES:
+            self.stats["retries"] += 1
+            if self.limiter is not None:
+                # the limiter holds back all the requests sharing its budget
+                self.limiter.pause(retry_after)
+                return 0.0
+            return retry_after
+        if is_endpoint_failure(ex) and self.stats["failovers"] < len(self.backend.endpoints) - 1:
+            # retry the request on a healthy replica
+            self.stats["failovers"] += 1
+            return 0.0
+        return None
+
+    def finish(self, result: Tuple[str, Optional[Dict], bool], hedge_info: Dict) -> str:
+        """Record the response of the request, :return: its text"""
+        response_text, usage, stopped = result
+        self.stats["latency"] += time.perf_counter() - self.request_start
+        record_usage(self.stats, usage)
+        self.stats["stopped_early"] = stopped
+        self.stats.update(hedge_info)
+        if self.cache is not None:
+            self.cache.put(self.key, response_text, usage)
+        self.log()
+        return response_text
+
+
+def send_prompt(
+    messages,
+    hyperparams: Dict,
+    request_log: List[Dict] = None,
+    route_key: Optional[str] = None,
+    stop_when: Optional[Callable[[str], bool]] = None,
+    use_cache: bool = True,
+):
+    """
+    :param messages: The conversation to send
+    :param hyperparams: The API hyperparameters of the run
+    :param request_log: If given, the usage, latency, queue wait and retries of the
+    request are appended to it
+    :param route_key: Requests with the same key (e.g. the document name) are sent
+    to the same endpoint of the backend while it is healthy
+    :param stop_when: With streaming enabled, the generation is cancelled as soon as
+    this holds for the text received so far
+    :param use_cache: If False, the request is sent even if its response is cached
+    (e.g. the cached one could not be parsed), and the new response is cached instead
+    :return: The text of the response
+    """
+    request = PromptRequest(messages, hyperparams, request_log, route_key, stop_when, use_cache)
+    if request.cached_text is not None:
+        return request.from_cache()
+
+    while True:
+        wait_start = time.perf_counter()
+        if request.limiter is not None:
+            request.limiter.acquire(estimate_tokens(messages))
+        request.start(time.perf_counter() - wait_start)
+        try:
+            result, hedge_info = run_hedged(
+                *request.hedged_requests(request_completion),
+                delay=get_hedge_delay(hyperparams),
+                deadline=hyperparams.get("deadline"),
+            )
+        except Exception as ex:
+            wait = request.retry_wait(ex)
+            if wait is None:
+                raise
+            time.sleep(wait)
         else:
-            prompt += f"""[INST]{message['content']}[/INST]"""
-            
-    client = InferenceClient(model=hyperparams["url"])
-    full_response = client.text_generation(
-        prompt=prompt,
-        max_new_tokens=600,
-        # details=True,
-        temperature=hyperparams["temp"],
-        do_sample=True,
-    )
-
-    generated_text = full_response#.generated_text
-    # completion_tokens = full_response.completion_tokens
-    # prompt_tokens = full_response.prompt_tokens
-    # total_tokens = full_response.total_tokens
-
-    return generated_text
-
-
-def send_prompt(messages, hyperparams: Dict):
-    if hyperparams["model"] in ["meta-llama/Llama-2-70b-chat-hf"]:
-        return send_llama_prompt(messages, hyperparams)
-
-    if hyperparams["model"] in ["mistralai/Mixtral-8x7B-Instruct-v0.1"]:
-        client = openai.Client(base_url=f"http://localhost:8080/v1", api_key="EMPTY")
-    else:
-        client = openai.Client()
-    response = client.chat.completions.create(
-        model=hyperparams["model"],
-        messages=messages,
-        temperature=hyperparams["temp"],
-        # request_timeout=1
-    )
-    response_text = response.choices[0].message.content
-    completion_tokens = response.usage.completion_tokens
-    prompt_tokens = response.usage.prompt_tokens
-    total_tokens = response.usage.total_tokens
-
-    return response_text
+            return request.finish(result, hedge_info)
+
 
+async def send_prompt_async(
+    messages,
+    hyperparams: Dict,
+    request_log: List[Dict] = None,
+    route_key: Optional[str] = None,
+    stop_when: Optional[Callable[[str], bool]] = None,
+    use_cache: bool = True,
+):
+    request = PromptRequest(messages, hyperparams, request_log, route_key, stop_when, use_cache)
+    if request.cached_text is not None:
+        return request.from_cache()
+
+    while True:
+        wait_start = time.perf_counter()
+        if request.limiter is not None:
+            await request.limiter.acquire_async(estimate_tokens(messages))
+        request.start(time.perf_counter() - wait_start)
+        try:
+            result, hedge_info = await run_hedged_async(
+                *request.hedged_requests(request_completion_async),
+                delay=get_hedge_delay(hyperparams),
+                deadline=hyperparams.get("deadline"),
+            )
+        except Exception as ex:
+            wait = request.retry_wait(ex)
+            if wait is None:
+                raise
+            await asyncio.sleep(wait)
+        else:
+            return request.finish(result, hedge_info)
@@ -0,0 +1,152 @@
+import mmap
+import pickle
+from collections import OrderedDict
+from itertools import islice
+from typing import Callable, Dict, List
+
+import llm_requests.strategies.batchqa as batchqa
+import llm_requests.strategies.cot as cot
+from llm_requests.windowing import build_context, document_sentences
+
+# Number of documents each worker keeps loaded
+DOC_CACHE_SIZE = 8
+
+PROMPT_GENERATORS = {
+    "batchqa": batchqa.iter_prompts,
+    "cot": cot.iter_prompts,
+}
+
+# Builders of the query of a single pair
+PROMPT_BUILDERS = {
+    "batchqa": batchqa.build_prompt,
+    "cot": cot.build_prompt,
+}
+
+# Per-process table, set by the worker initializer
+_TABLE = None
+
+
+class DocumentTable:
+    """
+    Read-only table of the documents, their events and candidate pairs, written once
+    by the parent to a file that the workers memory-map. A task then only carries a
+    reference (doc_name, query_idx) and the worker rebuilds the query from the table,
+    instead of receiving the prompt with the whole document for every pair.
+    """
+
+    def __init__(self, path: str, index: Dict[str, tuple], strategy: str, settings: Dict):
+        """
+        :param index: Offset and length of each document record in the file
+        :param strategy: The strategy whose iter_prompts builds the queries
+        :param settings: The keyword arguments of iter_prompts
+        """
+        self.path = path
+        self.index = index
+        self.strategy = strategy
+        self.settings = settings
+        self.mmap = None
+        self.documents = OrderedDict()
+
+    @classmethod
+    def build(
+        cls,
+        path: str,
+        doc_names: List[str],
+        texts: List[str],
+        events: List[List[Dict]],
+        candidate_pairs: List[List[Dict]],
+        strategy: str,
+        settings: Dict,
+    ) -> "DocumentTable":
+        index = {}
+        with open(path, "wb") as file:
+            for doc_name, doc, doc_events, pairs in zip(doc_names, texts, events, candidate_pairs):
+                record = pickle.dumps(
+                    {"doc": doc, "events": doc_events, "candidate_pairs": pairs},
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+                index[doc_name] = (file.tell(), len(record))
+                file.write(record)
+        return cls(path, index, strategy, settings)
+
+    def __getstate__(self):
+        # the map and the loaded documents are per process
+        state = self.__dict__.copy()
+        state["mmap"] = None
+        state["documents"] = OrderedDict()
+        return state
+
+    def load_document(self, doc_name: str) -> Dict:
+        if self.mmap is None:
+            with open(self.path, "rb") as file:
+                self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        offset, length = self.index[doc_name]
+        return pickle.loads(self.mmap[offset : offset + length])
+
+    def get_document(self, doc_name: str) -> Dict:
+        """The document record, with its sentences when the contexts are windowed"""
+        if doc_name not in self.documents:
+            document = self.load_document(doc_name)
+            if self.settings.get("context_tokens"):
+                document["sentences"] = document_sentences(document["doc"], document["events"])
+            self.documents[doc_name] = document
+            if len(self.documents) > DOC_CACHE_SIZE:
+                self.documents.popitem(last=False)
+        self.documents.move_to_end(doc_name)
+        return self.documents[doc_name]
+
+    def get_query(self, doc_name: str, query_idx: int) -> Dict:
+        """The query number `query_idx` generated for the document"""
+        document = self.get_document(doc_name)
+        if (self.settings.get("pairs_per_prompt") or 1) > 1:
+            # the packs depend on the pairs before them, generate up to the one asked
+            queries = PROMPT_GENERATORS[self.strategy](
+                doc=document["doc"],
+                doc_name=doc_name,
+                candidate_pairs=document["candidate_pairs"],
+                events=document["events"],
+                **self.settings,
+            )
+            return next(islice(queries, query_idx, None))
+
+        doc, pair = document["doc"], document["candidate_pairs"][query_idx]
+        context = doc
+        if self.settings.get("context_tokens"):
+            spans, section_times = document["sentences"]
+            context = build_context(
+                doc, pair, spans, section_times, self.settings["context_tokens"]
+            )
+        return PROMPT_BUILDERS[self.strategy](
+            doc, doc_name, pair, query_idx, context, self.settings["relations_scheme"]
+        )
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+
+def set_document_table(table: DocumentTable):
+    global _TABLE
+    _TABLE = table
+
+
+def get_document_table() -> DocumentTable:
+    if _TABLE is None:
+        raise RuntimeError("No document table was set for this process")
+    return _TABLE
+
+
+def make_ref(query: Dict, query_idx: int) -> Dict:
+    """The reference sent to the workers in place of a query"""
+    return {
+        "doc_name": query["doc_name"],
+        "query_idx": query_idx,
+        "unique_id": query["unique_id"],
+    }
+
+
+def process_ref(process_query: Callable, ref: Dict, *args):
+    """Rebuild the query of a reference from the table of the worker and process it"""
+    query = get_document_table().get_query(ref["doc_name"], ref["query_idx"])
+    return process_query(query, *args)
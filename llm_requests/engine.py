@@ -0,0 +1,278 @@
+import asyncio
+import threading
+import time
+from functools import partial
+from multiprocessing import Pool
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from llm_requests.backends import create_backend
+from llm_requests.connection import hyperparams_key, init_clients
+from llm_requests.doc_table import DocumentTable, set_document_table
+from llm_requests.metrics import compact_record
+from llm_requests.rate_limit import RateLimiter, set_rate_limiter
+from llm_requests.retry import RetryQueue, with_enqueue_time
+
+
+def init_worker(
+    api_hyperparams: Dict,
+    limiter: Optional[RateLimiter] = None,
+    table: Optional[DocumentTable] = None,
+):
+    """Set up the per-process state of a worker"""
+    init_clients()
+    set_rate_limiter(limiter)
+    set_document_table(table)
+
+
+def limit_concurrency(api_hyperparams: Dict, concurrency: int) -> int:
+    """Cap the concurrency of the run to the one the backend accepts"""
+    backend = create_backend(api_hyperparams)
+    if backend.max_concurrency is not None and backend.max_concurrency < concurrency:
+        print(f"Limiting concurrency to {backend.max_concurrency} for the {backend.name} backend")
+        return backend.max_concurrency
+    return concurrency
+
+
+def run_compact(process_query: Callable, *args) -> Union[Dict, List[Dict]]:
+    """Run a query and return its compact record (a list of them for packed queries)"""
+    results = process_query(*args)
+    if isinstance(results, list):
+        return [compact_record(record) for record in results]
+    return compact_record(results)
+
+
+async def run_compact_async(process_query_async: Callable, *args) -> Union[Dict, List[Dict]]:
+    results = await process_query_async(*args)
+    if isinstance(results, list):
+        return [compact_record(record) for record in results]
+    return compact_record(results)
+
+
+def run_pool(
+    process_query: Callable,
+    args_list: Iterable[Tuple],
+    api_hyperparams: Dict,
+    num_processes: int,
+    limiter: Optional[RateLimiter] = None,
+    max_pending: Optional[int] = None,
+    table: Optional[DocumentTable] = None,
+    retries: Optional[RetryQueue] = None,
+) -> List[Dict]:
+    """
+    Run the queries on a pool of worker processes, each with its own pooled client.
+    The queries are read lazily and dispatched one by one in the given order, with
+    at most max_pending (default: twice the processes) submitted and not finished.
+    With a document table the arguments can be references to its queries (see
+    doc_table.process_ref), the table is sent once to each worker.
+    :param retries: If given, the failed queries are enqueued again with a backoff
+    and dispatched before the next new ones
+    :return: The compact records of the queries, in the order they finished (a
+    retried query has one record per try)
+    """
+    num_processes = limit_concurrency(api_hyperparams, num_processes)
+    max_pending = max_pending or 2 * num_processes
+    results, errors = [], []
+    in_flight = 0
+    changed = threading.Condition()
+
+    def on_result(args, result):
+        nonlocal in_flight
+        results.append(result)
+        if retries is not None:
+            retries.schedule(args, result)
+        with changed:
+            in_flight -= 1
+            changed.notify()
+
+    def on_error(ex):
+        nonlocal in_flight
+        errors.append(ex)
+        with changed:
+            in_flight -= 1
+            changed.notify()
+
+    with Pool(
+        processes=num_processes,
+        initializer=init_worker,
+        initargs=(api_hyperparams, limiter, table),
+    ) as pool:
+        tasks = iter(args_list)
+        exhausted = False
+        while not errors:
+            with changed:
+                while in_flight >= max_pending:
+                    changed.wait()
+            args = retries.pop_due() if retries is not None else None
+            if args is not None:
+                args = with_enqueue_time(args)
+            elif not exhausted:
+                args = next(tasks, None)
+                exhausted = args is None
+            if args is None:
+                # only retries are left, wait until one is due or a query finishes
+                with changed:
+                    wait = retries.wait_time() if retries is not None else None
+                    if in_flight == 0 and wait is None:
+                        break
+                    changed.wait(wait)
+                continue
+            with changed:
+                in_flight += 1
+            pool.apply_async(
+                run_compact,
+                (process_query, *args),
+                callback=partial(on_result, args),
+                error_callback=on_error,
+            )
+        pool.close()
+        pool.join()
+
+    if errors:
+        raise errors[0]
+    return results
+
+
+async def gather_bounded(
+    process_query_async: Callable,
+    args_list: Iterable[Tuple],
+    max_in_flight: int,
+    retries: Optional[RetryQueue] = None,
+) -> List[Dict]:
+    """
+    Feed the queries through a bounded queue to max_in_flight worker tasks, so that
+    only the queries in flight (and a queue of as many) are built at any time
+    """
+    results, _ = await gather_interleaved(
+        [process_query_async],
+        [args_list],
+        [max_in_flight],
+        [retries] if retries is not None else None,
+    )
+    return results[0]
+
+
+def run_async(
+    process_query_async: Callable,
+    args_list: Iterable[Tuple],
+    api_hyperparams: Dict,
+    max_in_flight: int,
+    limiter: Optional[RateLimiter] = None,
+    retries: Optional[RetryQueue] = None,
+) -> List[Dict]:
+    """
+    Run the queries concurrently in a single process, with at most max_in_flight
+    requests waiting on the network at any time.
+    :return: The compact records of the queries, in the order they finished (a
+    retried query has one record per try)
+    """
+    max_in_flight = limit_concurrency(api_hyperparams, max_in_flight)
+    init_worker(api_hyperparams, limiter)
+    return asyncio.run(
+        gather_bounded(process_query_async, args_list, max_in_flight, retries)
+    )
+
+
+async def gather_interleaved(
+    process_fns: List[Callable],
+    tasks: List[Iterable[Tuple]],
+    limits: List[int],
+    retries: Optional[List[RetryQueue]] = None,
+) -> Tuple[List[List[Dict]], List[float]]:
+    """
+    Like gather_bounded for several jobs at once: each job has its own producer
+    reading its stream of tasks into its own bounded queue, served by as many
+    worker tasks as the concurrency limit of the job, so that a job waiting on a
+    slow backend does not hold back the others.
+    :param tasks: The arguments of the queries of each job
+    :param retries: The retry queue of each job, its due retries are enqueued before
+    the next new task
+    :return: The compact records of each job, in the order they finished, and the
+    wall time of each job until its last query was processed
+    """
+    start = time.time()
+    queues = [asyncio.Queue(maxsize=limit) for limit in limits]
+    results = [[] for _ in limits]
+    # tasks of each job enqueued and not processed yet, and an event set when one is
+    outstanding = [0 for _ in limits]
+    progress = [asyncio.Event() for _ in limits]
+    wall_times = [0.0 for _ in limits]
+
+    async def worker(job: int):
+        while True:
+            args = await queues[job].get()
+            if args is None:
+                return
+            result = await run_compact_async(process_fns[job], *args)
+            results[job].append(result)
+            if retries is not None:
+                retries[job].schedule(args, result)
+            outstanding[job] -= 1
+            progress[job].set()
+
+    async def put(job: int, args: Tuple):
+        outstanding[job] += 1
+        await queues[job].put(args)
+
+    async def put_due_retries(job: int):
+        if retries is None:
+            return
+        args = retries[job].pop_due()
+        while args is not None:
+            await put(job, with_enqueue_time(args))
+            args = retries[job].pop_due()
+
+    async def producer(job: int):
+        for args in tasks[job]:
+            await put_due_retries(job)
+            await put(job, args)
+        while retries is not None:
+            await put_due_retries(job)
+            wait = retries[job].wait_time()
+            if wait is None and outstanding[job] == 0:
+                break
+            progress[job].clear()
+            try:
+                await asyncio.wait_for(progress[job].wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+        for _ in range(limits[job]):
+            await queues[job].put(None)
+
+    async def run_job(job: int):
+        await asyncio.gather(producer(job), *(worker(job) for _ in range(limits[job])))
+        wall_times[job] = time.time() - start
+
+    running = [asyncio.ensure_future(run_job(job)) for job in range(len(limits))]
+    try:
+        await asyncio.gather(*running)
+    finally:
+        for task in running:
+            task.cancel()
+    return results, wall_times
+
+
+def run_interleaved(
+    process_fns: List[Callable],
+    tasks: List[Iterable[Tuple]],
+    hyperparams_list: List[Dict],
+    limits: List[int],
+    limiters: Optional[List[Optional[RateLimiter]]] = None,
+    retries: Optional[List[RetryQueue]] = None,
+) -> Tuple[List[List[Dict]], List[float]]:
+    """
+    Run the queries of several jobs (a model, backend and strategy each) concurrently
+    in a single process, with at most limits[job] requests of a job in flight, so
+    that a slow backend does not hold back the others.
+    :param tasks: The arguments of the queries of each job
+    :param limiters: The request/token budget of each job, jobs can share one
+    :return: The compact records of each job, in the order they finished, and the
+    wall time of each job
+    """
+    limits = [
+        limit_concurrency(hyperparams, limit)
+        for hyperparams, limit in zip(hyperparams_list, limits)
+    ]
+    init_worker(hyperparams_list[0])
+    for hyperparams, limiter in zip(hyperparams_list, limiters or []):
+        set_rate_limiter(limiter, hyperparams_key(hyperparams))
+    return asyncio.run(gather_interleaved(process_fns, tasks, limits, retries))
@@ -0,0 +1,186 @@
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import llm_requests.strategies.batchqa as batchqa
+from llm_requests.metrics import percentile
+from llm_requests.rate_limit import CHARS_PER_TOKEN, COMPLETION_TOKENS_ESTIMATE
+
+# Number of distinct text chunks given to the tokenizer at once
+TOKENIZE_BATCH_SIZE = 2048
+# Tokens added by the chat format to each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def load_token_counter(model: str) -> Tuple[str, Callable[[List[str]], List[int]]]:
+    """
+    The tokenizer of the model if one is available locally: tiktoken for the OpenAI
+    models, otherwise a cached Hugging Face tokenizer. Without any, the tokens are
+    approximated from the number of characters.
+    :return: The name of the tokenizer and a function counting the tokens of a batch of texts
+    """
+    try:
+        import tiktoken
+
+        encoding = tiktoken.encoding_for_model(model)
+        return f"tiktoken/{encoding.name}", lambda texts: [
+            len(tokens) for tokens in encoding.encode_ordinary_batch(texts)
+        ]
+    except (ImportError, KeyError):
+        pass
+
+    try:
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(model, local_files_only=True)
+        return f"transformers/{model}", lambda texts: [
+            len(input_ids)
+            for input_ids in tokenizer(texts, add_special_tokens=False)["input_ids"]
+        ]
+    except (ImportError, OSError, ValueError):
+        pass
+
+    return f"approximation ({CHARS_PER_TOKEN} characters per token)", lambda texts: [
+        len(text) // CHARS_PER_TOKEN for text in texts
+    ]
+
+
+def split_chunks(text: str) -> List[str]:
+    """
+    Split a text after its lines and sentences. The prompts of a document repeat the
+    same sentences, so each distinct chunk is tokenized only once and the tokens of
+    a prompt are the sum of its chunks'.
+    """
+    return [chunk for chunk in re.split(r"(?<=\n)|(?<=\. )", text) if chunk]
+
+
+def simulate_requests(
+    prompt: Dict, strategy: str, hyperparams: Dict, response_tokens: int
+) -> List[Tuple[List[str], int]]:
+    """
+    The requests a query sends when every answer is parsed on the first try. The
+    cot history grows by one answer and one question per turn, all the relation
+    questions are counted (pruning can only ask fewer).
+    :return: The message contents of each request and the tokens of the previous
+    responses it resends
+    """
+    if strategy == "batchqa":
+        if "queries" in prompt:
+            numbered_queries = list(enumerate(prompt["queries"], start=1))
+            messages = batchqa.build_packed_messages(prompt, numbered_queries)
+        else:
+            messages = batchqa.build_messages(prompt)
+        return [([message["content"] for message in messages], 0)]
+
+    doc_text_prompt = prompt["prompt_info"]["doc_text_prompt"]
+    question_prompts = prompt["prompt_info"]["question_prompts"]
+    requests = [([doc_text_prompt], 0)]
+    if hyperparams.get("cot_mode") == "parallel":
+        for question in question_prompts:
+            requests.append(([doc_text_prompt, question], response_tokens))
+    else:
+        for turn in range(1, len(question_prompts) + 1):
+            requests.append(([doc_text_prompt] + question_prompts[:turn], turn * response_tokens))
+    return requests
+
+
+def estimate_run(
+    prompts: Iterable[Dict],
+    strategy: str,
+    hyperparams: Dict,
+    response_tokens: int = COMPLETION_TOKENS_ESTIMATE,
+) -> Dict:
+    """
+    Count the tokens of all the requests of a run without sending them
+    :param response_tokens: Expected tokens of each response, counted as completion
+    tokens and, for cot, in the history of the following turns
+    :return: The number of queries and requests and the prompt token statistics
+    """
+    tokenizer_name, count_tokens = load_token_counter(hyperparams["model"])
+    chunk_ids: Dict[str, int] = {}
+    chunk_tokens: List[int] = []
+    pending: List[str] = []
+    # the cot turns resend the same messages, each distinct one is split once
+    content_ids: Dict[str, int] = {}
+    content_chunks: List[List[int]] = []
+    # the content ids of each request's messages and its fixed tokens
+    requests: List[Tuple[List[int], int]] = []
+
+    def tokenize_pending():
+        chunk_tokens.extend(count_tokens(pending))
+        pending.clear()
+
+    num_queries = 0
+    for prompt in prompts:
+        num_queries += len(prompt.get("queries", [prompt]))
+        for contents, history_tokens in simulate_requests(
+            prompt, strategy, hyperparams, response_tokens
+        ):
+            for content in contents:
+                if content in content_ids:
+                    continue
+                content_ids[content] = len(content_chunks)
+                ids = []
+                for chunk in split_chunks(content):
+                    if chunk not in chunk_ids:
+                        chunk_ids[chunk] = len(chunk_ids)
+                        pending.append(chunk)
+                    ids.append(chunk_ids[chunk])
+                content_chunks.append(ids)
+            # an assistant message between each two user messages
+            fixed_tokens = history_tokens + MESSAGE_OVERHEAD_TOKENS * (2 * len(contents) - 1)
+            requests.append(([content_ids[content] for content in contents], fixed_tokens))
+            if len(pending) >= TOKENIZE_BATCH_SIZE:
+                tokenize_pending()
+    tokenize_pending()
+
+    content_tokens = [sum(chunk_tokens[chunk_id] for chunk_id in ids) for ids in content_chunks]
+    prompt_tokens = [
+        sum(content_tokens[content_id] for content_id in ids) + fixed_tokens
+        for ids, fixed_tokens in requests
+    ]
+    return {
+        "tokenizer": tokenizer_name,
+        "queries": num_queries,
+        "requests": len(requests),
+        "prompt_tokens": sum(prompt_tokens),
+        "prompt_tokens_p50": percentile(prompt_tokens, 50),
+        "prompt_tokens_p90": percentile(prompt_tokens, 90),
+        "prompt_tokens_p99": percentile(prompt_tokens, 99),
+        "prompt_tokens_max": max(prompt_tokens, default=None),
+        "completion_tokens": response_tokens * len(requests),
+    }
+
+
+def project_run(
+    estimate: Dict,
+    price_input: Optional[float] = None,
+    price_output: Optional[float] = None,
+    requests_per_sec: Optional[float] = None,
+    rpm: Optional[float] = None,
+    tpm: Optional[float] = None,
+) -> Dict:
+    """
+    :param price_input: Price of a million prompt tokens
+    :param price_output: Price of a million completion tokens
+    :param requests_per_sec: Expected throughput of the server
+    :param rpm: Requests per minute budget of the run
+    :param tpm: Tokens per minute budget of the run
+    :return: The estimated cost and duration (in seconds) of the run, None when
+    unknown
+    """
+    cost = None
+    if price_input is not None or price_output is not None:
+        cost = (
+            estimate["prompt_tokens"] * (price_input or 0)
+            + estimate["completion_tokens"] * (price_output or 0)
+        ) / 1e6
+
+    # the run takes as long as its tightest limit allows
+    durations = []
+    if requests_per_sec:
+        durations.append(estimate["requests"] / requests_per_sec)
+    if rpm:
+        durations.append(60 * estimate["requests"] / rpm)
+    if tpm:
+        durations.append(60 * (estimate["prompt_tokens"] + estimate["completion_tokens"]) / tpm)
+    return {"cost": cost, "duration": max(durations) if durations else None}
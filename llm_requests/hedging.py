@@ -0,0 +1,180 @@
+import asyncio
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from llm_requests.metrics import percentile
+
+# Number of recent latencies kept to estimate the hedging delay
+LATENCY_WINDOW = 1000
+# Latencies needed before the quantile is trusted to trigger hedges
+MIN_SAMPLES = 20
+# Threads of the synchronous engine, requests that lost a race keep theirs until they return
+HEDGE_THREADS = 32
+
+# Per-process state, rebuilt in forked workers
+_TRACKER = None
+_EXECUTOR = None
+
+
+class LatencyTracker:
+    """Rolling window of the latencies of successful requests"""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.latencies = deque(maxlen=window)
+
+    def add(self, latency: float):
+        self.latencies.append(latency)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self.latencies) < MIN_SAMPLES:
+            return None
+        return percentile(list(self.latencies), q)
+
+    def expected_remaining(self, elapsed: float) -> float:
+        """Expected time left for a request that has already run for `elapsed` seconds"""
+        slower = [latency for latency in self.latencies if latency > elapsed]
+        if not slower:
+            return 0.0
+        return sum(slower) / len(slower) - elapsed
+
+
+def get_tracker() -> LatencyTracker:
+    global _TRACKER
+    if _TRACKER is None or _TRACKER[0] != os.getpid():
+        _TRACKER = (os.getpid(), LatencyTracker())
+    return _TRACKER[1]
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _EXECUTOR
+    if _EXECUTOR is None or _EXECUTOR[0] != os.getpid():
+        _EXECUTOR = (os.getpid(), ThreadPoolExecutor(max_workers=HEDGE_THREADS))
+    return _EXECUTOR[1]
+
+
+def get_hedge_delay(hyperparams: Dict) -> Optional[float]:
+    """
+    :return: Seconds after which a duplicate of a request is sent, or None for no hedging
+    """
+    if hyperparams.get("hedge_after"):
+        return hyperparams["hedge_after"]
+    if not hyperparams.get("hedge"):
+        return None
+    return get_tracker().quantile(hyperparams.get("hedge_quantile") or 95)
+
+
+def new_hedge_info() -> Dict:
+    return {"hedged": False, "hedge_won": False, "hedge_saved": 0.0}
+
+
+def record_win(info: Dict, winner: str, elapsed: float):
+    tracker = get_tracker()
+    if winner == "hedge":
+        info["hedge_won"] = True
+        # estimated from the latencies of the requests slower than the elapsed time
+        info["hedge_saved"] = tracker.expected_remaining(elapsed)
+    tracker.add(elapsed)
+
+
+def run_hedged(
+    primary: Callable,
+    hedge: Callable,
+    delay: Optional[float],
+    deadline: Optional[float],
+) -> Tuple[object, Dict]:
+    """
+    Run the primary request, and if it has not returned after `delay` seconds a
+    duplicate one; the first successful response wins. Raises TimeoutError if no
+    response arrives within `deadline` seconds.
+    The thread of the losing request cannot be interrupted, its response is dropped.
+    :return: The result of the winning request and the hedging stats
+    """
+    info = new_hedge_info()
+    start = time.perf_counter()
+    if delay is None and deadline is None:
+        result = primary()
+        record_win(info, "primary", time.perf_counter() - start)
+        return result, info
+
+    executor = get_executor()
+    futures = {executor.submit(primary): "primary"}
+    error = None
+    while futures:
+        elapsed = time.perf_counter() - start
+        timeout = deadline - elapsed if deadline is not None else None
+        if not info["hedged"] and delay is not None:
+            timeout = delay - elapsed if timeout is None else min(timeout, delay - elapsed)
+        done, _ = wait(
+            futures,
+            timeout=max(timeout, 0) if timeout is not None else None,
+            return_when=FIRST_COMPLETED,
+        )
+
+        for future in done:
+            name = futures.pop(future)
+            if future.exception() is None:
+                for pending in futures:
+                    pending.cancel()
+                record_win(info, name, time.perf_counter() - start)
+                return future.result(), info
+            error = future.exception()
+
+        elapsed = time.perf_counter() - start
+        if deadline is not None and elapsed >= deadline:
+            for pending in futures:
+                pending.cancel()
+            raise TimeoutError(f"No response within the deadline of {deadline}s")
+        if not info["hedged"] and delay is not None and elapsed >= delay and futures:
+            futures[executor.submit(hedge)] = "hedge"
+            info["hedged"] = True
+
+    raise error
+
+
+async def run_hedged_async(
+    primary: Callable[[], Awaitable],
+    hedge: Callable[[], Awaitable],
+    delay: Optional[float],
+    deadline: Optional[float],
+) -> Tuple[object, Dict]:
+    """
+    Same as run_hedged for coroutines, here the losing request is cancelled
+    (which closes its connection and aborts the generation on the server).
+    """
+    info = new_hedge_info()
+    start = time.perf_counter()
+    tasks = {asyncio.ensure_future(primary()): "primary"}
+    error = None
+    try:
+        while tasks:
+            elapsed = time.perf_counter() - start
+            timeout = deadline - elapsed if deadline is not None else None
+            if not info["hedged"] and delay is not None:
+                timeout = delay - elapsed if timeout is None else min(timeout, delay - elapsed)
+            done, _ = await asyncio.wait(
+                tasks,
+                timeout=max(timeout, 0) if timeout is not None else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+
+            for task in done:
+                name = tasks.pop(task)
+                if task.exception() is None:
+                    record_win(info, name, time.perf_counter() - start)
+                    return task.result(), info
+                error = task.exception()
+
+            elapsed = time.perf_counter() - start
+            if deadline is not None and elapsed >= deadline:
+                raise TimeoutError(f"No response within the deadline of {deadline}s")
+            if not info["hedged"] and delay is not None and elapsed >= delay and tasks:
+                tasks[asyncio.ensure_future(hedge())] = "hedge"
+                info["hedged"] = True
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    raise error
@@ -0,0 +1,147 @@
+import json
+import os
+import time
+from typing import Dict, List, Optional, Union
+
+
+def new_request_stats() -> Dict:
+    return {
+        "started": time.time(),
+        "latency": 0.0,
+        "queue_wait": 0.0,
+        "retries": 0,
+        "failovers": 0,
+        "stopped_early": False,
+        "cached": False,
+        "hedged": False,
+        "hedge_won": False,
+        "hedge_saved": 0.0,
+        "prompt_tokens": None,
+        "completion_tokens": None,
+        "total_tokens": None,
+    }
+
+
+def record_usage(stats: Dict, usage: Optional[Dict]):
+    """Copy the token usage reported by the server into the stats of a request"""
+    if not usage:
+        return
+    for field in ["prompt_tokens", "completion_tokens", "total_tokens"]:
+        if usage.get(field) is not None:
+            stats[field] = usage[field]
+    if usage.get("total_tokens") is None:
+        stats["total_tokens"] = (stats["prompt_tokens"] or 0) + (stats["completion_tokens"] or 0)
+
+
+def record_dispatch_wait(results: Dict, enqueued_at: Optional[float]):
+    """Add the time a query waited in the engine before a worker picked it up"""
+    if enqueued_at is not None:
+        results["dispatch_wait"] = results.get("dispatch_wait", 0.0) + max(
+            0.0, time.time() - enqueued_at
+        )
+
+
+def update_totals(results: Dict):
+    """Sum the stats of all the requests of a query (over all its tries)"""
+    requests = results.get("requests", [])
+    for field in ["prompt_tokens", "completion_tokens", "total_tokens"]:
+        results[field] = sum(request[field] or 0 for request in requests)
+    results["latency"] = sum(request["latency"] for request in requests)
+    results["queue_wait"] = results.get("dispatch_wait", 0.0) + sum(
+        request["queue_wait"] for request in requests
+    )
+    results["retries"] = sum(request["retries"] for request in requests)
+
+
+def compact_record(results: Dict) -> Dict:
+    """
+    The fields of a result record needed once its query is done (without the
+    prompt and the messages), so that a run only keeps these in memory
+    """
+    return {
+        "unique_id": results["query"]["unique_id"],
+        "finished": results["finished"],
+        "num_tries": results["num_tries"],
+        "errors": results["errors"],
+        "error_class": results.get("error_class"),
+        "requests": results.get("requests", []),
+    }
+
+
+def latest_records(results: List[Union[Dict, List[Dict]]]) -> List[Dict]:
+    """
+    The last compact record of each query, from the records returned by the engine
+    (one list per packed prompt, and one record per try of the retried queries)
+    """
+    latest = {}
+    for result in results:
+        for record in result if isinstance(result, list) else [result]:
+            latest[record["unique_id"]] = record
+    return list(latest.values())
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Percentile with linear interpolation, q in [0, 100]"""
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize_run(
+    records: List[Dict], run_start: float, wall_time: float, model: str, strategy: str
+) -> Dict:
+    """
+    :param records: The result records returned by process_query
+    :param run_start: Timestamp of the start of the run, older requests (of resumed
+    queries) are not counted
+    :param wall_time: Duration of the run in seconds
+    :return: Throughput, token usage and latency percentiles of the run
+    """
+    requests = [
+        request
+        for record in records
+        for request in record.get("requests", [])
+        if request["started"] >= run_start
+    ]
+    # responses from the cache did not reach the server
+    latencies = [request["latency"] for request in requests if not request.get("cached")]
+    queue_waits = [request["queue_wait"] for request in requests]
+    prompt_tokens = sum(request["prompt_tokens"] or 0 for request in requests)
+    completion_tokens = sum(request["completion_tokens"] or 0 for request in requests)
+    total_tokens = sum(request["total_tokens"] or 0 for request in requests)
+
+    return {
+        "model": model,
+        "strategy": strategy,
+        "queries": len(records),
+        "finished": sum(1 for record in records if record["finished"]),
+        "requests": len(requests),
+        "retries": sum(request["retries"] for request in requests),
+        "failovers": sum(request.get("failovers", 0) for request in requests),
+        "cache_hits": sum(1 for request in requests if request.get("cached")),
+        "stopped_early": sum(1 for request in requests if request.get("stopped_early")),
+        "hedges_fired": sum(1 for request in requests if request.get("hedged")),
+        "hedges_won": sum(1 for request in requests if request.get("hedge_won")),
+        "hedge_saved": sum(request.get("hedge_saved", 0.0) for request in requests),
+        "wall_time": wall_time,
+        "requests_per_sec": len(requests) / wall_time if wall_time else None,
+        "tokens_per_sec": total_tokens / wall_time if wall_time else None,
+        "completion_tokens_per_sec": completion_tokens / wall_time if wall_time else None,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": total_tokens,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "queue_wait_p50": percentile(queue_waits, 50),
+        "queue_wait_p99": percentile(queue_waits, 99),
+    }
+
+
+def save_run_summary(summary: Dict, save_path: str, filename: str = "run_summary.json"):
+    with open(os.path.join(save_path, filename), "w") as file:
+        json.dump(summary, file, indent=4)
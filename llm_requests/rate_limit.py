@@ -0,0 +1,148 @@
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+from multiprocessing import Array, Lock
+from typing import Dict, List, Optional
+
+# Rough number of characters per token, used to estimate the cost of a prompt
+CHARS_PER_TOKEN = 4
+# Tokens we expect the model to generate for one of our (short) answers
+COMPLETION_TOKENS_ESTIMATE = 50
+
+# Indices in the shared state array
+_REQUESTS, _TOKENS, _LAST_REFILL, _PAUSED_UNTIL = range(4)
+
+# Limiters shared by the workers of the current run, set by set_rate_limiter: the
+# one of the run under None, or one per configuration of a sweep
+_LIMITERS: Dict[Optional[str], "RateLimiter"] = {}
+
+
+def estimate_tokens(messages: List[Dict]) -> int:
+    """Estimate the tokens a request will consume (prompt + answer)"""
+    prompt_chars = sum(len(message["content"]) for message in messages)
+    return prompt_chars // CHARS_PER_TOKEN + 4 * len(messages) + COMPLETION_TOKENS_ESTIMATE
+
+
+class RateLimiter:
+    """
+    Token buckets for the requests-per-minute and tokens-per-minute budgets of a
+    hosted model. The state lives in shared memory, so one limiter created in the
+    parent process is honored by all the workers of the pool.
+    """
+
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.lock = Lock()
+        self.state = Array(
+            "d", [rpm or 0.0, tpm or 0.0, time.monotonic(), 0.0], lock=False
+        )
+
+    def _refill(self, now: float):
+        elapsed = now - self.state[_LAST_REFILL]
+        if self.rpm:
+            self.state[_REQUESTS] = min(
+                self.rpm, self.state[_REQUESTS] + elapsed * self.rpm / 60
+            )
+        if self.tpm:
+            self.state[_TOKENS] = min(
+                self.tpm, self.state[_TOKENS] + elapsed * self.tpm / 60
+            )
+        self.state[_LAST_REFILL] = now
+
+    def try_acquire(self, tokens: int) -> float:
+        """
+        Take one request and the given tokens from the budget if available.
+        :return: 0 if the request may be sent now, otherwise the seconds to wait
+        before trying again
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now < self.state[_PAUSED_UNTIL]:
+                return self.state[_PAUSED_UNTIL] - now
+
+            self._refill(now)
+            wait = 0.0
+            if self.rpm and self.state[_REQUESTS] < 1:
+                wait = max(wait, (1 - self.state[_REQUESTS]) * 60 / self.rpm)
+            if self.tpm:
+                # a prompt larger than the whole budget is let through on a full bucket
+                tokens = min(tokens, self.tpm)
+                if self.state[_TOKENS] < tokens:
+                    wait = max(wait, (tokens - self.state[_TOKENS]) * 60 / self.tpm)
+            if wait > 0:
+                return wait
+
+            if self.rpm:
+                self.state[_REQUESTS] -= 1
+            if self.tpm:
+                self.state[_TOKENS] -= tokens
+            return 0.0
+
+    def acquire(self, tokens: int):
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: int):
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Stop all workers from sending requests for the given seconds (e.g. on a 429)"""
+        with self.lock:
+            self.state[_PAUSED_UNTIL] = max(
+                self.state[_PAUSED_UNTIL], time.monotonic() + seconds
+            )
+
+
+def set_rate_limiter(limiter: Optional[RateLimiter], key: Optional[str] = None):
+    """
+    :param key: The key of the hyperparameters of the configuration the limiter is
+    for, None to set the limiter of all the requests (and drop the other ones)
+    """
+    if key is None:
+        _LIMITERS.clear()
+    if limiter is not None:
+        _LIMITERS[key] = limiter
+
+
+def get_rate_limiter(key: Optional[str] = None) -> Optional[RateLimiter]:
+    """:param key: The key of the hyperparameters of the request"""
+    return _LIMITERS.get(key) or _LIMITERS.get(None)
+
+
+def get_retry_after(ex: Exception) -> Optional[float]:
+    """
+    :param ex: Exception raised by a client
+    :return: The seconds to wait if the exception is a rate limit (429) error, otherwise None
+    """
+    response = getattr(ex, "response", None)
+    status_code = getattr(response, "status_code", None)
+    if status_code != 429:
+        return None
+
+    headers = getattr(response, "headers", None) or {}
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+        try:
+            # HTTP date format
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    # no hint from the server, back off for one refill period of a request
+    return 1.0
@@ -0,0 +1,184 @@
+import asyncio
+import heapq
+import itertools
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Union
+
+import httpx
+import openai
+
+from llm_requests.balancer import is_endpoint_failure
+from llm_requests.rate_limit import get_retry_after
+
+# Classes of the errors of a try, each with its own retry policy
+RATE_LIMIT, TIMEOUT, SERVER, PARSE, OTHER = "rate_limit", "timeout", "server", "parse", "other"
+
+
+class ResponseParseError(ValueError):
+    """The response of the model does not have the expected answers"""
+
+
+class RetryPolicy:
+    """How many tries a query gets for a class of errors, and how long it waits between them"""
+
+    def __init__(self, max_tries: int, base_delay: float = 0.0, max_delay: float = 0.0):
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, num_tries: int, rng: random.Random) -> float:
+        """Exponential backoff with full jitter, after the try number num_tries"""
+        backoff = min(self.max_delay, self.base_delay * 2 ** max(0, num_tries - 1))
+        return rng.uniform(0, backoff)
+
+
+RETRY_POLICIES = {
+    # the rate limit waits of the requests themselves are exhausted, back off longer
+    RATE_LIMIT: RetryPolicy(max_tries=8, base_delay=2.0, max_delay=60.0),
+    TIMEOUT: RetryPolicy(max_tries=4, base_delay=1.0, max_delay=30.0),
+    SERVER: RetryPolicy(max_tries=5, base_delay=1.0, max_delay=30.0),
+    # a new sample may be well formed, no need to wait
+    PARSE: RetryPolicy(max_tries=3),
+    # bad requests and bugs fail the same way every time
+    OTHER: RetryPolicy(max_tries=1),
+}
+# Tries of a query for the most lenient policy
+DEFAULT_MAX_TRIES = max(policy.max_tries for policy in RETRY_POLICIES.values())
+
+
+def out_of_tries(
+    num_tries: int,
+    error_class: Optional[str],
+    max_tries: int = None,
+    policies: Dict[str, RetryPolicy] = None,
+) -> bool:
+    """
+    Whether an unfinished query gets no more tries, after num_tries tries whose
+    last one failed with an error of error_class (see RETRY_POLICIES)
+    :param max_tries: Tries of a query whatever its errors (the policies give fewer)
+    """
+    if max_tries is not None and num_tries >= max_tries:
+        return True
+    return num_tries >= (policies or RETRY_POLICIES)[error_class or OTHER].max_tries
+
+
+def classify_error(ex: Exception) -> str:
+    """:return: The class of the error of a try (see RETRY_POLICIES)"""
+    if isinstance(ex, ResponseParseError):
+        return PARSE
+    if get_retry_after(ex) is not None:
+        return RATE_LIMIT
+    if isinstance(
+        ex,
+        (TimeoutError, asyncio.TimeoutError, openai.APITimeoutError, httpx.TimeoutException),
+    ):
+        return TIMEOUT
+    if is_endpoint_failure(ex):
+        return SERVER
+    return OTHER
+
+
+def with_enqueue_time(args: tuple) -> tuple:
+    """The arguments of a task, whose last one is enqueued_at, enqueued now"""
+    return args[:-1] + (time.time(),)
+
+
+class RetryQueue:
+    """
+    The tasks whose query failed, waiting for their next try within the run. The
+    engines take the due retries before new tasks; the queries out of tries for
+    the class of their last error are reported as failed.
+    """
+
+    def __init__(
+        self,
+        max_tries: int = DEFAULT_MAX_TRIES,
+        policies: Dict[str, RetryPolicy] = None,
+        seed: Optional[int] = None,
+    ):
+        """
+        :param max_tries: Tries of a query whatever its errors (the policies give fewer)
+        """
+        self.max_tries = max_tries
+        self.policies = policies or RETRY_POLICIES
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.heap = []
+        self.counter = itertools.count()
+        self.retries = {error_class: 0 for error_class in self.policies}
+        self.failed: Dict[str, Dict] = {}
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.heap)
+
+    def retry_delay(self, record: Dict) -> Optional[float]:
+        """:return: The backoff before the next try of a query, None if it gets no more tries"""
+        error_class = record.get("error_class")
+        if record["finished"] or out_of_tries(
+            record["num_tries"], error_class, self.max_tries, self.policies
+        ):
+            return None
+        return self.policies[error_class or OTHER].delay(record["num_tries"], self.rng)
+
+    def schedule(self, task, records: Union[Dict, List[Dict]]) -> bool:
+        """
+        Enqueue the task again if its query (any pair of a pack) can be retried
+        :param records: The compact record(s) returned by the task
+        :return: Whether the task was enqueued
+        """
+        if isinstance(records, dict):
+            records = [records]
+        delays = []
+        with self.lock:
+            for record in records:
+                unique_id = record["unique_id"]
+                delay = self.retry_delay(record)
+                if delay is not None:
+                    delays.append(delay)
+                    self.retries[record.get("error_class") or OTHER] += 1
+                    self.failed.pop(unique_id, None)
+                elif record["finished"]:
+                    self.failed.pop(unique_id, None)
+                else:
+                    self.failed[unique_id] = {
+                        "error_class": record.get("error_class") or OTHER,
+                        "num_tries": record["num_tries"],
+                        # the keys are strings in the records read back from the store
+                        "error": record["errors"].get(
+                            record["num_tries"] - 1,
+                            record["errors"].get(str(record["num_tries"] - 1)),
+                        ),
+                    }
+            if not delays:
+                return False
+            heapq.heappush(self.heap, (time.monotonic() + max(delays), next(self.counter), task))
+        return True
+
+    def pop_due(self):
+        """:return: A task whose backoff has elapsed, None if there is none"""
+        with self.lock:
+            if self.heap and self.heap[0][0] <= time.monotonic():
+                return heapq.heappop(self.heap)[2]
+        return None
+
+    def wait_time(self) -> Optional[float]:
+        """:return: The seconds until the next retry is due, None if none is waiting"""
+        with self.lock:
+            if not self.heap:
+                return None
+            return max(0.0, self.heap[0][0] - time.monotonic())
+
+    def report(self) -> Dict:
+        with self.lock:
+            by_class = {}
+            for failure in self.failed.values():
+                by_class[failure["error_class"]] = by_class.get(failure["error_class"], 0) + 1
+            return {
+                "retries": dict(self.retries),
+                "failed": len(self.failed),
+                "failed_by_class": by_class,
+                "failed_queries": dict(sorted(self.failed.items())),
+            }
@@ -0,0 +1,73 @@
+import hashlib
+import zlib
+from collections import deque
+from itertools import groupby
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+def order_by_document(prompts: Iterable[Dict], window: int) -> Iterator[Dict]:
+    """
+    Order the queries so that at most `window` documents are being queried at any
+    time: the queries of the active documents are interleaved, and a new document
+    only starts when one of them has no queries left. All the requests in flight
+    then share one of a few document prefixes, which the server can keep in its
+    prefix (KV) cache.
+
+    The prompts are read lazily, only the queries of the active documents are held.
+
+    :param prompts: The queries, as generated by iter_prompts (grouped by document)
+    :param window: The maximum number of documents with queries in flight
+    :return: The queries in dispatch order
+    """
+    documents = (
+        deque(queries) for _, queries in groupby(prompts, key=lambda prompt: prompt["doc_name"])
+    )
+
+    active = []
+    while True:
+        while len(active) < window:
+            queries = next(documents, None)
+            if queries is None:
+                break
+            active.append(queries)
+        if not active:
+            return
+        for queries in active:
+            yield queries.popleft()
+        active = [queries for queries in active if queries]
+
+
+def route(key: Optional[str], endpoints: List) -> int:
+    """
+    Sticky routing: the same key (e.g. the document name) is always sent to the same
+    endpoint, so that its prefix is cached on only one server.
+    :return: The index of the endpoint for the key
+    """
+    if key is None or len(endpoints) == 1:
+        return 0
+    return zlib.crc32(key.encode("utf-8")) % len(endpoints)
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """
+    :param shard: "i/N", the shard i (from 0) of N
+    :return: The shard index and the number of shards
+    """
+    try:
+        index, count = (int(part) for part in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard {shard}, expected i/N, e.g. 0/4")
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard {shard}, the index must be in [0, {count})")
+    return index, count
+
+
+def in_shard(key: str, index: int, count: int) -> bool:
+    """
+    Deterministic partition of the queries across machines: a key (unique_id or
+    doc_name) always belongs to the same shard, whatever the order or the subset of
+    the queries. Not crc32 as in route, so that the shards are spread over the
+    replicas of a shared server.
+    """
+    digest = hashlib.md5(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count == index
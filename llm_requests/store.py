@@ -0,0 +1,253 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from llm_requests.retry import out_of_tries
+
+# Stores of the current process by (kind, path), opened lazily by get_store
+_STORES = {}
+_STORES_PID = None
+
+
+class ResultStore:
+    """
+    Where the result records of the queries are kept, keyed by their unique_id.
+    A store is opened on a location (the save directory of a run).
+    """
+
+    name = None
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def get(self, unique_id: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    def put(self, results: Dict, indent: int = None):
+        """Save a result record, replacing the previous one of its query"""
+        raise NotImplementedError
+
+    def ids(self) -> List[str]:
+        raise NotImplementedError
+
+    def __iter__(self) -> Iterator[Dict]:
+        for unique_id in self.ids():
+            yield self.get(unique_id)
+
+    def statuses(self) -> Dict[str, Tuple[bool, int, Optional[str]]]:
+        """
+        Whether each saved query is finished, its number of tries and the class of
+        its last error, in one scan
+        """
+        return {
+            results["query"]["unique_id"]: (
+                results["finished"],
+                results["num_tries"],
+                results.get("error_class"),
+            )
+            for results in self
+        }
+
+    def close(self):
+        pass
+
+
+class JsonStore(ResultStore):
+    """One JSON file per query in the directory, written atomically"""
+
+    name = "json"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        os.makedirs(path, exist_ok=True)
+
+    def file_path(self, unique_id: str) -> str:
+        return os.path.join(self.path, f"{unique_id}.json")
+
+    def get(self, unique_id: str) -> Optional[Dict]:
+        try:
+            with open(self.file_path(unique_id), "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def put(self, results: Dict, indent: int = None):
+        # write a temporary file and move it over the record, so that a crash
+        # never leaves a truncated record
+        save_file = self.file_path(results["query"]["unique_id"])
+        tmp_file = f"{save_file}.tmp"
+        try:
+            with open(tmp_file, "w") as file:
+                json.dump(results, file, indent=indent)
+            os.replace(tmp_file, save_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def ids(self) -> List[str]:
+        return [
+            filename[: -len(".json")]
+            for filename in os.listdir(self.path)
+            if filename.endswith(".json")
+        ]
+
+
+class SQLiteStore(ResultStore):
+    """
+    All the records in results.db in the directory, a SQLite database in WAL mode
+    shared by the worker processes (SQLite serializes their writes)
+    """
+
+    name = "sqlite"
+    FILENAME = "results.db"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            os.path.join(path, self.FILENAME), timeout=60, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "unique_id TEXT PRIMARY KEY, finished INTEGER, num_tries INTEGER, record TEXT, "
+            "error_class TEXT)"
+        )
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(results)")]
+        if "error_class" not in columns:
+            # a database of an older run, the classes are read from its records
+            self.connection.execute("ALTER TABLE results ADD COLUMN error_class TEXT")
+            self.connection.execute(
+                "UPDATE results SET error_class = json_extract(record, '$.error_class')"
+            )
+        self.connection.commit()
+
+    def get(self, unique_id: str) -> Optional[Dict]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT record FROM results WHERE unique_id = ?", (unique_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, results: Dict, indent: int = None):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results "
+                "(unique_id, finished, num_tries, record, error_class) VALUES (?, ?, ?, ?, ?)",
+                (
+                    results["query"]["unique_id"],
+                    int(results["finished"]),
+                    results["num_tries"],
+                    json.dumps(results),
+                    results.get("error_class"),
+                ),
+            )
+
+    def ids(self) -> List[str]:
+        with self.lock:
+            rows = self.connection.execute("SELECT unique_id FROM results").fetchall()
+        return [unique_id for (unique_id,) in rows]
+
+    def __iter__(self) -> Iterator[Dict]:
+        with self.lock:
+            rows = self.connection.execute("SELECT record FROM results").fetchall()
+        for (record,) in rows:
+            yield json.loads(record)
+
+    def statuses(self) -> Dict[str, Tuple[bool, int, Optional[str]]]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT unique_id, finished, num_tries, error_class FROM results"
+            ).fetchall()
+        return {
+            unique_id: (bool(finished), num_tries, error_class)
+            for unique_id, finished, num_tries, error_class in rows
+        }
+
+    def close(self):
+        self.connection.close()
+
+
+STORES = {store.name: store for store in [JsonStore, SQLiteStore]}
+
+
+class Manifest:
+    """
+    The state of the queries of a previous run, read before dispatching a resumed
+    run so that the finished queries (and the ones out of tries for the class of
+    their last error, as RetryQueue decides within a run) are not sent
+    """
+
+    def __init__(
+        self, statuses: Dict[str, Tuple[bool, int, Optional[str]]], max_tries: int = None
+    ):
+        self.statuses = statuses
+        self.max_tries = max_tries
+        self.skipped = 0
+        self.dispatched = 0
+
+    @classmethod
+    def load(cls, kind: str, path: str, max_tries: int = None) -> "Manifest":
+        store = open_store(kind, path)
+        try:
+            return cls(store.statuses(), max_tries)
+        finally:
+            store.close()
+
+    def is_pending(self, unique_id: str) -> bool:
+        if unique_id not in self.statuses:
+            return True
+        finished, num_tries, error_class = self.statuses[unique_id]
+        if finished:
+            return False
+        return not out_of_tries(num_tries, error_class, self.max_tries)
+
+    def should_dispatch(self, prompt: Dict) -> bool:
+        """Whether a query has work left (for packed queries, any of their pairs)"""
+        unique_ids = [query["unique_id"] for query in prompt.get("queries", [prompt])]
+        if any(self.is_pending(unique_id) for unique_id in unique_ids):
+            self.dispatched += 1
+            return True
+        self.skipped += 1
+        return False
+
+    def summary(self) -> Dict[str, int]:
+        finished = sum(1 for finished, _, _ in self.statuses.values() if finished)
+        exhausted = sum(
+            1
+            for finished, num_tries, error_class in self.statuses.values()
+            if not finished and out_of_tries(num_tries, error_class, self.max_tries)
+        )
+        return {
+            "saved": len(self.statuses),
+            "finished": finished,
+            "exhausted": exhausted,
+            "retried": len(self.statuses) - finished - exhausted,
+        }
+
+
+def open_store(kind: str, path: str) -> ResultStore:
+    if kind not in STORES:
+        raise ValueError(f"Unknown result store {kind}, available: {list(STORES)}")
+    return STORES[kind](path)
+
+
+def get_store(hyperparams: Dict, save_dir: str) -> ResultStore:
+    """
+    :return: The result store of the run in the current process, the kind of
+    store is the "store" hyperparameter (default: json)
+    """
+    global _STORES_PID
+    kind = hyperparams.get("store") or "json"
+    # sqlite connections must not be shared with forked workers
+    if _STORES_PID != os.getpid():
+        _STORES.clear()
+        _STORES_PID = os.getpid()
+    # a sweep keeps the stores of all its configurations open
+    if (kind, save_dir) not in _STORES:
+        _STORES[(kind, save_dir)] = open_store(kind, save_dir)
+    return _STORES[(kind, save_dir)]
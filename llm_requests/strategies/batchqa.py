@@ -1,53 +1,157 @@
-from typing import List, Dict
-import os
+from functools import partial
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple
 import re
-import json
 
-from llm_requests.strategies.common import generate_questions, initialize_result_dict
-from llm_requests.connection import send_prompt
+from llm_requests.strategies.common import (
+    generate_questions,
+    is_done,
+    record_error,
+    start_try,
+)
+from llm_requests.connection import send_prompt, send_prompt_async
+from llm_requests.metrics import update_totals
+from llm_requests.store import ResultStore
+from llm_requests.rate_limit import CHARS_PER_TOKEN
+from llm_requests.retry import PARSE, ResponseParseError
+from llm_requests.windowing import pair_contexts
 
 
-def generate_prompt(
-    doc: str, doc_name: str, candidate_pairs: List[Dict], relations_scheme: List[str]
-):
-    all_prompts = []
-
+def generate_preamble(doc: str) -> str:
     # Generate preamble with the documents text + the instruction for the model
-    preamble = f"""Input document D:
+    return f"""Input document D:
 
 {doc}
 ----------------------
 Given document D, answer the following questions ONLY with Yes or No.
 """
 
+
+def iter_prompts(
+    doc: str,
+    doc_name: str,
+    candidate_pairs: List[Dict],
+    relations_scheme: List[str],
+    events: List[Dict] = None,
+    context_tokens: int = None,
+    pairs_per_prompt: int = 1,
+    pack_tokens: int = None,
+) -> Iterator[Dict]:
+    """
+    Generate the queries of a document one at a time, so that they can be sent
+    while the next ones are built.
+    :param events: The events of the document, used to find the admission and discharge dates
+    :param context_tokens: If set, only the sentences around each pair (and the section
+    times) up to about this many tokens are given as document instead of the whole text
+    :param pairs_per_prompt: Number of pairs asked in the same prompt, see pack_prompts
+    :param pack_tokens: Maximum estimated tokens of a prompt with several pairs
+    """
+    if pairs_per_prompt > 1:
+        queries = iter_prompts(doc, doc_name, candidate_pairs, relations_scheme)
+        yield from pack_prompts(doc, doc_name, queries, pairs_per_prompt, pack_tokens)
+        return
+
+    contexts = [doc] * len(candidate_pairs)
+    if context_tokens:
+        contexts = pair_contexts(doc, candidate_pairs, context_tokens, events=events)
+
     # Generate prompt for each pair of candidate
     for idx, pair in enumerate(candidate_pairs):
-        tlinkID = pair["tlinkID"]
-        from_id = pair["fromID"]
-        to_id = pair["toID"]
-
-        event_1 = pair["fromText"]
-        event_2 = pair["toText"]
-        questions = generate_questions(relations_scheme, event_1, event_2)
-        questions = [f"Q{idx+1}: " + q for idx, q in enumerate(questions)]
-        prompt_info = (
-            preamble
-            + " \n ".join(questions)
-            + "\n Each line should contain an answer, e.g. 'A1: yes'. Make sure the output format is matched exactly."
-        )
+        yield build_prompt(doc, doc_name, pair, idx, contexts[idx], relations_scheme)
+
+
+def build_prompt(
+    doc: str, doc_name: str, pair: Dict, pair_idx: int, context: str, relations_scheme: List[str]
+) -> Dict:
+    """The query of the pair number `pair_idx`, given `context` as document"""
+    from_id = pair["fromID"]
+    to_id = pair["toID"]
+
+    event_1 = pair["fromText"]
+    event_2 = pair["toText"]
+    pair_questions = generate_questions(relations_scheme, event_1, event_2)
+    questions = [f"Q{idx+1}: " + q for idx, q in enumerate(pair_questions)]
+    prompt_info = (
+        generate_preamble(context)
+        + " \n ".join(questions)
+        + "\n Each line should contain an answer, e.g. 'A1: yes'. Make sure the output format is matched exactly."
+    )
 
-        all_prompts.append(
-            {
-                "prompt_info": prompt_info,
-                "num_questions": len(questions),
-                "pair_idx": idx,
-                "pair": pair,
-                "doc_name": doc_name,
-                "unique_id": f"{doc_name}_{from_id}_{to_id}",
-            }
+    return {
+        "prompt_info": prompt_info,
+        "num_questions": len(questions),
+        "pair_idx": pair_idx,
+        "pair": pair,
+        "doc_name": doc_name,
+        "unique_id": f"{doc_name}_{from_id}_{to_id}",
+        "doc_length": len(doc),
+        "context_length": len(context),
+        "questions": pair_questions,
+    }
+
+
+def generate_prompt(
+    doc: str, doc_name: str, candidate_pairs: List[Dict], relations_scheme: List[str], **kwargs
+) -> List[Dict]:
+    """All the queries of a document, see iter_prompts"""
+    return list(iter_prompts(doc, doc_name, candidate_pairs, relations_scheme, **kwargs))
+
+
+def pack_questions(numbered_queries: List[Tuple[int, Dict]]) -> str:
+    """The questions of several pairs, with ids like P3-Q2 for the question 2 of pair 3"""
+    lines = []
+    for pair_number, query in numbered_queries:
+        lines.extend(
+            f"P{pair_number}-Q{idx+1}: " + q for idx, q in enumerate(query["questions"])
         )
+    return (
+        " \n ".join(lines)
+        + "\n Each line should contain an answer, e.g. 'P1-A1: yes'. Make sure the output format is matched exactly."
+    )
+
+
+def pack_prompts(
+    doc: str,
+    doc_name: str,
+    queries: Iterable[Dict],
+    pairs_per_prompt: int,
+    pack_tokens: int = None,
+) -> Iterator[Dict]:
+    """
+    Group the queries of a document by `pairs_per_prompt` so that the document is
+    sent once for all the pairs of a group. A group is closed early when its
+    estimated prompt would exceed `pack_tokens`.
+    The pairs keep their own unique_id and result file.
+    """
+    preamble = generate_preamble(doc)
+
+    def num_tokens(numbered_queries):
+        return (len(preamble) + len(pack_questions(numbered_queries))) // CHARS_PER_TOKEN
+
+    def make_pack(idx, pack):
+        return {
+            "prompt_info": preamble,
+            "queries": [query for _, query in pack],
+            "num_questions": sum(query["num_questions"] for _, query in pack),
+            "doc_name": doc_name,
+            "unique_id": f"{doc_name}_pack{idx}",
+            "doc_length": sum(query["doc_length"] for _, query in pack),
+            "context_length": len(doc),
+        }
 
-    return all_prompts
+    num_packs, current = 0, []
+    for query in queries:
+        query = {key: value for key, value in query.items() if key != "prompt_info"}
+        candidate = current + [(len(current) + 1, query)]
+        if current and (
+            len(current) >= pairs_per_prompt
+            or (pack_tokens and num_tokens(candidate) > pack_tokens)
+        ):
+            yield make_pack(num_packs, current)
+            num_packs += 1
+            candidate = [(1, query)]
+        current = candidate
+    if current:
+        yield make_pack(num_packs, current)
 
 
 def extract_answer(resp):
@@ -62,67 +166,301 @@ def extract_answer(resp):
         return question_id, "unsure"
 
 
+def answers_complete(response: str, num_answers: int) -> bool:
+    """Check whether a (partial, streamed) response already has all its answer lines"""
+    answered = {int(q_id) for q_id in re.findall(r"A(\d+): .*\n", response)}
+    return answered >= set(range(1, num_answers + 1))
+
+
+def packed_answers_complete(response: str, num_answers: Dict[int, int]) -> bool:
+    """answers_complete for a prompt with several pairs, num_answers per pair number"""
+    answered = {
+        (int(p_id), int(q_id)) for p_id, q_id in re.findall(r"P(\d+)-A(\d+): .*\n", response)
+    }
+    return all(
+        (pair_number, q_id) in answered
+        for pair_number, n in num_answers.items()
+        for q_id in range(1, n + 1)
+    )
+
+
 def transform_response(response: str, num_answers: int):
     answers = re.findall(r"A(\d+): (.*?)$", response, flags=re.MULTILINE)
     answers = dict(map(extract_answer, answers))
     if len(answers) != num_answers:
-        raise ValueError("Number of answers does not match number of questions.")
+        raise ResponseParseError("Number of answers does not match number of questions.")
 
     answers = [answers[i] for i in range(num_answers)]
     return answers
 
 
-def process_query(
-    query: Dict, api_hyperparams: Dict, save_dir: str, max_tries: int = None
+def transform_packed_response(
+    response: str, num_answers: Dict[int, int]
+) -> Dict[int, List[str]]:
+    """
+    Split the answers of a prompt with several pairs.
+    :param num_answers: Number of questions of each pair number
+    :return: The answers of each pair number, the pairs with missing answers are left out
+    """
+    answers = {}
+    for p_id, q_id, answer in re.findall(
+        r"P(\d+)-A(\d+): (.*?)$", response, flags=re.MULTILINE
+    ):
+        question_id, answer = extract_answer((q_id, answer))
+        answers.setdefault(int(p_id), {})[question_id] = answer
+
+    return {
+        pair_number: [answers[pair_number][i] for i in range(n)]
+        for pair_number, n in num_answers.items()
+        if set(answers.get(pair_number, {})) >= set(range(n))
+    }
+
+
+def build_messages(query: Dict) -> List[Dict]:
+    return [
+        {
+            "role": "user",
+            "content": query["prompt_info"],
+        }
+    ]
+
+
+def record_response(results: Dict, query: Dict, messages: List[Dict], response_text: str):
+    results["messages"] = messages
+    results["responses"] = [response_text]
+
+    # process answer
+    results["answers"] = transform_response(
+        response_text, num_answers=query["num_questions"]
+    )
+
+    # extract info
+    # results["completion_tokens"] = completion_tokens
+    # results["prompt_tokens"] = prompt_tokens
+    # results["total_tokens"] = total_tokens
+
+    # mark as finished
+    results["finished"] = True
+
+
+def record_packed_response(
+    results: Dict,
+    messages: List[Dict],
+    response_text: str,
+    answers: List[str] = None,
+    error: Exception = None,
 ):
-    prompt = query["prompt_info"]
-    unique_id = query["unique_id"]
-    save_file = os.path.join(save_dir, f"{unique_id}.json")
-
-    # check cache or initialize
-    if os.path.exists(save_file):
-        with open(save_file, "r") as file:
-            results = json.load(file)
-    else:
-        # set initial values
-        results = initialize_result_dict(query)
+    """record_response for a pair of a packed prompt, or its error if it got no answers"""
+    if answers is None:
+        record_error(results, error)
+        return
+    results["messages"] = messages
+    results["responses"] = [response_text]
+    results["answers"] = answers
+    results["finished"] = True
+
+
+def save_results(results: Dict, store: ResultStore) -> Dict:
+    # count tries, in case we want to account for API errors etc.
+    results["num_tries"] += 1
+    update_totals(results)
+
+    # save
+    store.put(results, indent=4)
+    return results
+
+
+def send_options(query: Dict, results: Dict) -> Dict:
+    """The keyword arguments of send_prompt for the query"""
+    return {
+        "route_key": query["doc_name"],
+        "stop_when": partial(answers_complete, num_answers=query["num_questions"]),
+        # a cached response that could not be parsed would fail the same way
+        "use_cache": results.get("error_class") != PARSE,
+    }
 
-    if results["finished"]:
+
+def process_query(
+    query: Dict,
+    api_hyperparams: Dict,
+    save_dir: str,
+    max_tries: int = None,
+    enqueued_at: float = None,
+):
+    store, results = start_try(query, api_hyperparams, save_dir, max_tries, enqueued_at)
+    if is_done(results, max_tries):
         return results
-    elif max_tries is not None and results["num_tries"] >= max_tries:
+    request_log = results.setdefault("requests", [])
+
+    try:
+        messages = build_messages(query)
+        response_text = send_prompt(
+            messages, api_hyperparams, request_log, **send_options(query, results)
+        )
+        record_response(results, query, messages, response_text)
+    except Exception as ex:
+        record_error(results, ex)
+
+    return save_results(results, store)
+
+
+async def process_query_async(
+    query: Dict,
+    api_hyperparams: Dict,
+    save_dir: str,
+    max_tries: int = None,
+    enqueued_at: float = None,
+):
+    store, results = start_try(query, api_hyperparams, save_dir, max_tries, enqueued_at)
+    if is_done(results, max_tries):
         return results
+    request_log = results.setdefault("requests", [])
 
     try:
-        messages = [
-            {
-                "role": "user",
-                "content": prompt,
-            }
-        ]
-        response_text = send_prompt(messages, api_hyperparams)
-        results["messages"] = messages
-        results["responses"] = [response_text]
-
-        # process answer
-        results["answers"] = transform_response(
-            response_text, num_answers=query["num_questions"]
+        messages = build_messages(query)
+        response_text = await send_prompt_async(
+            messages, api_hyperparams, request_log, **send_options(query, results)
+        )
+        record_response(results, query, messages, response_text)
+    except Exception as ex:
+        record_error(results, ex)
+
+    return save_results(results, store)
+
+
+def build_packed_messages(pack: Dict, numbered_queries: List[Tuple[int, Dict]]) -> List[Dict]:
+    return [
+        {
+            "role": "user",
+            "content": pack["prompt_info"] + pack_questions(numbered_queries),
+        }
+    ]
+
+
+def start_pack(
+    pack: Dict,
+    api_hyperparams: Dict,
+    save_dir: str,
+    max_tries: int = None,
+    enqueued_at: float = None,
+) -> Tuple[ResultStore, List[Dict], List[Tuple[int, Dict]]]:
+    """
+    start_try for the pairs of a pack
+    :return: The result store, the results of the pairs and the pairs (numbered from
+    1) that are not done, which a new try asks again
+    """
+    all_results = []
+    for query in pack["queries"]:
+        store, results = start_try(query, api_hyperparams, save_dir, max_tries, enqueued_at)
+        all_results.append(results)
+    pending = [
+        (pair_number, query)
+        for pair_number, query in enumerate(pack["queries"], start=1)
+        if not is_done(all_results[pair_number - 1], max_tries)
+    ]
+    return store, all_results, pending
+
+
+def pack_send_options(
+    pack: Dict, all_results: List[Dict], pending: List[Tuple[int, Dict]]
+) -> Dict:
+    """send_options for the pending pairs of a pack"""
+    num_answers = {pair_number: query["num_questions"] for pair_number, query in pending}
+    return {
+        "route_key": pack["doc_name"],
+        "stop_when": partial(packed_answers_complete, num_answers=num_answers),
+        "use_cache": all(
+            all_results[pair_number - 1].get("error_class") != PARSE
+            for pair_number, _ in pending
+        ),
+    }
+
+
+def record_pack(
+    store: ResultStore,
+    all_results: List[Dict],
+    pending: List[Tuple[int, Dict]],
+    messages: List[Dict],
+    response_text: Optional[str],
+    error: Optional[Exception] = None,
+):
+    """
+    Record and save the answers of the pending pairs of a pack, or the error of
+    the request, the pairs without answers get a parse error
+    """
+    answers = {}
+    if error is None:
+        num_answers = {pair_number: query["num_questions"] for pair_number, query in pending}
+        try:
+            answers = transform_packed_response(response_text, num_answers)
+        except Exception as ex:
+            error = ex
+        else:
+            error = ResponseParseError("No answers for the pair in the response")
+
+    for pair_number, query in pending:
+        record_packed_response(
+            all_results[pair_number - 1],
+            messages,
+            response_text,
+            answers=answers.get(pair_number),
+            error=error,
         )
+        save_results(all_results[pair_number - 1], store)
 
-        # extract info
-        # results["completion_tokens"] = completion_tokens
-        # results["prompt_tokens"] = prompt_tokens
-        # results["total_tokens"] = total_tokens
 
-        # mark as finished
-        results["finished"] = True
+def process_pack(
+    pack: Dict,
+    api_hyperparams: Dict,
+    save_dir: str,
+    max_tries: int = None,
+    enqueued_at: float = None,
+) -> List[Dict]:
+    """
+    process_query for a group of pairs asked in the same prompt (see pack_prompts).
+    A new try (see retry.RetryQueue) only asks the pairs with missing answers again.
+    :return: The result records of the pairs
+    """
+    store, all_results, pending = start_pack(
+        pack, api_hyperparams, save_dir, max_tries, enqueued_at
+    )
+    if not pending:
+        return all_results
+    # the request is logged with the first pending pair, the others have no
+    # requests of their own
+    request_log = all_results[pending[0][0] - 1].setdefault("requests", [])
 
+    messages, response_text, error = build_packed_messages(pack, pending), None, None
+    try:
+        response_text = send_prompt(
+            messages, api_hyperparams, request_log, **pack_send_options(pack, all_results, pending)
+        )
     except Exception as ex:
-        results["errors"][results["num_tries"]] = str(ex)
+        error = ex
+    record_pack(store, all_results, pending, messages, response_text, error)
+    return all_results
 
-    # count tries, in case we want to account for API errors etc.
-    results["num_tries"] += 1
 
-    # save
-    with open(save_file, "w") as file:
-        json.dump(results, file, indent=4)
-    return results
\ No newline at end of file
+async def process_pack_async(
+    pack: Dict,
+    api_hyperparams: Dict,
+    save_dir: str,
+    max_tries: int = None,
+    enqueued_at: float = None,
+) -> List[Dict]:
+    store, all_results, pending = start_pack(
+        pack, api_hyperparams, save_dir, max_tries, enqueued_at
+    )
+    if not pending:
+        return all_results
+    request_log = all_results[pending[0][0] - 1].setdefault("requests", [])
+
+    messages, response_text, error = build_packed_messages(pack, pending), None, None
+    try:
+        response_text = await send_prompt_async(
+            messages, api_hyperparams, request_log, **pack_send_options(pack, all_results, pending)
+        )
+    except Exception as ex:
+        error = ex
+    record_pack(store, all_results, pending, messages, response_text, error)
+    return all_results
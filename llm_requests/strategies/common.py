@@ -1,4 +1,8 @@
-from typing import List, Tuple
+from typing import Dict, List, Tuple
+
+from llm_requests.metrics import record_dispatch_wait
+from llm_requests.retry import classify_error, out_of_tries
+from llm_requests.store import ResultStore, get_store
 
 
 # generate questions according to the relation schema
@@ -48,7 +52,53 @@ def initialize_result_dict(query):
         "completion_tokens": 0,
         "prompt_tokens": 0,
         "total_tokens": 0,
+        "latency": 0.0,
+        "queue_wait": 0.0,
+        "dispatch_wait": 0.0,
+        "retries": 0,
+        "requests": [],
         "errors": {},
         "num_tries": 0,
         "finished": False,
-    }
\ No newline at end of file
+    }
+
+
+def load_results(query: Dict, store) -> Dict:
+    """Load the saved results of a query from the result store, or initialize them"""
+    # check cache or initialize
+    results = store.get(query["unique_id"])
+    if results is None:
+        # set initial values
+        results = initialize_result_dict(query)
+    return results
+
+
+def record_error(results: Dict, ex: Exception):
+    """Record the error of the current try and its class, which decides its retries"""
+    results["errors"][results["num_tries"]] = str(ex)
+    results["error_class"] = classify_error(ex)
+
+
+def is_done(results: Dict, max_tries: int = None) -> bool:
+    """Check whether a query is finished or has used up its tries (see out_of_tries)"""
+    if results["finished"]:
+        return True
+    return out_of_tries(results["num_tries"], results.get("error_class"), max_tries)
+
+
+def start_try(
+    query: Dict,
+    api_hyperparams: Dict,
+    save_dir: str,
+    max_tries: int = None,
+    enqueued_at: float = None,
+) -> Tuple[ResultStore, Dict]:
+    """
+    The result store of the run and the saved results of the query, with the time
+    the query waited for a worker if it is not done yet (see is_done)
+    """
+    store = get_store(api_hyperparams, save_dir)
+    results = load_results(query, store)
+    if not is_done(results, max_tries):
+        record_dispatch_wait(results, enqueued_at)
+    return store, results
@@ -1,58 +1,102 @@
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Iterator, List, Dict, Optional, Tuple
+import asyncio
 import os
-import json
+import threading
 
-from llm_requests.strategies.common import generate_questions, initialize_result_dict
-from llm_requests.connection import send_prompt
+from llm_requests.strategies.common import (
+    generate_questions,
+    is_done,
+    record_error,
+    start_try,
+)
+from llm_requests.connection import send_prompt, send_prompt_async
+from llm_requests.metrics import update_totals
+from llm_requests.store import ResultStore
+from llm_requests.windowing import pair_contexts
 
 
-def generate_prompt(
-    doc: str,
-    doc_name: str,
-    candidate_pairs: List[Dict],
-    relations_scheme: List,
-):
-    all_prompts = []
+# Relations of which at most one holds for a pair, so that a yes answers the others
+EXCLUSIVE_RELATIONS = {"BEFORE", "AFTER", "INCLUDES", "IS INCLUDED", "SIMULTANEOUS"}
 
-    # generate preamble
-    preamble = f"""Input document D:
+# Per-process counts of the yes answers of each relation, for the ordered pruning
+_YES_COUNTS = None
+
+
+def generate_preamble(doc: str) -> str:
+    return f"""Input document D:
 
 {doc}
 ----------------------
 """
 
+
+def iter_prompts(
+    doc: str,
+    doc_name: str,
+    candidate_pairs: List[Dict],
+    relations_scheme: List,
+    events: List[Dict] = None,
+    context_tokens: int = None,
+) -> Iterator[Dict]:
+    """
+    Generate the queries of a document one at a time, so that they can be sent
+    while the next ones are built.
+    :param events: The events of the document, used to find the admission and discharge dates
+    :param context_tokens: If set, only the sentences around each pair (and the section
+    times) up to about this many tokens are given as document instead of the whole text
+    """
+    # generate preamble
+    contexts = [doc] * len(candidate_pairs)
+    if context_tokens:
+        contexts = pair_contexts(doc, candidate_pairs, context_tokens, events=events)
+
     # generate prompt for each pair of candidate
     for idx, pair in enumerate(candidate_pairs):
-        event_1 = pair["fromText"]
-        event_2 = pair["toText"]
+        yield build_prompt(doc, doc_name, pair, idx, contexts[idx], relations_scheme)
 
-        from_id = pair["fromID"]
-        to_id = pair["toID"]
 
-        doc_text_prompt = (
-            preamble
-            + f" Given the document D, are '{event_1}' and '{event_2}' referring to the same event? Answer ONLY with Yes or No."
-        )
+def build_prompt(
+    doc: str, doc_name: str, pair: Dict, pair_idx: int, context: str, relations_scheme: List
+) -> Dict:
+    """The query of the pair number `pair_idx`, given `context` as document"""
+    event_1 = pair["fromText"]
+    event_2 = pair["toText"]
 
-        question_prompts = generate_questions(relations_scheme, event_1, event_2)
+    from_id = pair["fromID"]
+    to_id = pair["toID"]
 
-        prompts = {
-            "doc_text_prompt": doc_text_prompt,
-            "question_prompts": question_prompts,
-        }
+    doc_text_prompt = (
+        generate_preamble(context)
+        + f" Given the document D, are '{event_1}' and '{event_2}' referring to the same event? Answer ONLY with Yes or No."
+    )
 
-        all_prompts.append(
-            {
-                "prompt_info": prompts,
-                "num_questions": len(question_prompts),
-                "pair": pair,
-                "pair_idx": idx,
-                "doc_name": doc_name,
-                "unique_id": f"{doc_name}_{from_id}_{to_id}",
-            }
-        )
+    question_prompts = generate_questions(relations_scheme, event_1, event_2)
 
-    return all_prompts
+    prompts = {
+        "doc_text_prompt": doc_text_prompt,
+        "question_prompts": question_prompts,
+    }
+
+    return {
+        "prompt_info": prompts,
+        "num_questions": len(question_prompts),
+        "pair": pair,
+        "pair_idx": pair_idx,
+        "doc_name": doc_name,
+        "unique_id": f"{doc_name}_{from_id}_{to_id}",
+        "doc_length": len(doc),
+        "context_length": len(context),
+        "relations": list(relations_scheme),
+    }
+
+
+def generate_prompt(
+    doc: str, doc_name: str, candidate_pairs: List[Dict], relations_scheme: List, **kwargs
+) -> List[Dict]:
+    """All the queries of a document, see iter_prompts"""
+    return list(iter_prompts(doc, doc_name, candidate_pairs, relations_scheme, **kwargs))
 
 
 def extract_answer(response_text):
@@ -65,69 +109,340 @@ def extract_answer(response_text):
         return -1
 
 
-def process_query(
-    query: Dict, api_hyperparams: Dict, save_dir: str, max_tries: int = None
+def first_line_complete(response_text: str) -> bool:
+    """Only the first line of a response is used, so a streamed one can stop after it"""
+    return "\n" in response_text
+
+
+def follow_up_questions(question_prompts: List[str], response_text: str) -> List[str]:
+    is_same_event = extract_answer(response_text)
+    if is_same_event == "yes":
+        question_prompts = [
+            "In that event, " + prompt[:1].lower() + prompt[1:]
+            for prompt in question_prompts
+        ]
+    return question_prompts
+
+
+def record_conversation(
+    results: Dict, messages: List[Dict], responses: List[str], answers: List
 ):
-    unique_id = query["unique_id"]
-    save_file = os.path.join(save_dir, f"{unique_id}.json")
+    messages.append({"role": "assistant", "content": responses[-1]})
+    # fill results dict
+    results["messages"] = messages
+    results["responses"] = responses
+    results["answers"] = answers
 
-    # check cache or initialize
-    if os.path.exists(save_file):
-        with open(save_file, "r") as file:
-            results = json.load(file)
-    else:
-        # set initial values
-        results = initialize_result_dict(query)
+    # mark as finished
+    results["finished"] = True
 
-    if results["finished"]:
-        return results
-    elif max_tries is not None and results["num_tries"] >= max_tries:
-        return results
 
-    try:
-        doc_text_prompt = query["prompt_info"]["doc_text_prompt"]
-        question_prompts = query["prompt_info"]["question_prompts"]
+def can_prune(query: Dict, api_hyperparams: Dict) -> bool:
+    """Pruning needs the relations of the query to be mutually exclusive"""
+    relations = query.get("relations")
+    return (
+        api_hyperparams.get("cot_prune", "none") != "none"
+        and relations is not None
+        and set(relations) <= EXCLUSIVE_RELATIONS
+    )
 
-        responses = []
-        messages = [{"role": "user", "content": doc_text_prompt}]
-        # print(json.dumps(messages, indent=4))
-        response_text = send_prompt(messages, api_hyperparams)
-        responses.append(response_text)
 
-        is_same_event = extract_answer(response_text)
-        if is_same_event == "yes":
-            question_prompts = [
-                "In that event, " + prompt[:1].lower() + prompt[1:]
-                for prompt in question_prompts
-            ]
+def get_yes_counts() -> Dict[str, int]:
+    global _YES_COUNTS
+    if _YES_COUNTS is None or _YES_COUNTS[0] != os.getpid():
+        _YES_COUNTS = (os.getpid(), {})
+    return _YES_COUNTS[1]
 
-        answers = []
 
-        for question in question_prompts:
-            messages.append({"role": "assistant", "content": response_text})
-            messages.append({"role": "user", "content": question})
+def question_order(query: Dict, api_hyperparams: Dict) -> List[int]:
+    """
+    Order in which the relation questions are asked: the scheme order, or with
+    the "ordered" pruning the relations answered yes most often so far first
+    """
+    order = list(range(query["num_questions"]))
+    if api_hyperparams.get("cot_prune") == "ordered" and can_prune(query, api_hyperparams):
+        counts = get_yes_counts()
+        order.sort(key=lambda i: -counts.get(query["relations"][i], 0))
+    return order
 
-            response_text = send_prompt(messages, api_hyperparams)
 
-            responses.append(response_text)
-            answers.append(extract_answer(response_text.lower()))
+def record_yes(query: Dict, answers: List):
+    counts = get_yes_counts()
+    for relation, answer in zip(query["relations"], answers):
+        if answer == "yes":
+            counts[relation] = counts.get(relation, 0) + 1
 
-        messages.append({"role": "assistant", "content": response_text})
-        # fill results dict
-        results["messages"] = messages
-        results["responses"] = responses
-        results["answers"] = answers
 
-        # mark as finished
-        results["finished"] = True
+def branch_messages(
+    messages: List[Dict], response_text: str, question_prompts: List[str]
+) -> List[List[Dict]]:
+    """
+    The conversations of the relation questions asked in parallel, each one
+    continues the same-event turn with a single question
+    """
+    prefix = messages + [{"role": "assistant", "content": response_text}]
+    return [prefix + [{"role": "user", "content": question}] for question in question_prompts]
 
-    except Exception as ex:
-        results["errors"][results["num_tries"]] = str(ex)
 
+def record_branches(
+    results: Dict, branches: List[List[Dict]], responses: List[str], answers: List
+):
+    """record_conversation for the parallel mode: the shared turn and one branch per question"""
+    results["messages"] = branches[0][:2] if branches else []
+    results["branches"] = [
+        branch[2:] + [{"role": "assistant", "content": response}]
+        for branch, response in zip(branches, responses[1:])
+    ]
+    results["responses"] = responses
+    results["answers"] = answers
+
+    # mark as finished
+    results["finished"] = True
+
+
+def save_results(results: Dict, store: ResultStore) -> Dict:
     # count tries, in case we want to account for API errors etc.
     results["num_tries"] += 1
+    update_totals(results)
+    if results["finished"]:
+        results.pop("checkpoint", None)
 
     # save
-    with open(save_file, "w") as file:
-        json.dump(results, file)
+    store.put(results)
     return results
+
+
+def load_checkpoint(results: Dict, query: Dict, api_hyperparams: Dict) -> Dict:
+    """
+    The state of the conversation saved after its last successful turn (by a failed
+    try or an interrupted run), or a new one
+    """
+    checkpoint = results.get("checkpoint")
+    if checkpoint is None:
+        checkpoint = {
+            "messages": [{"role": "user", "content": query["prompt_info"]["doc_text_prompt"]}],
+            "responses": [],
+            "answers": [-1] * query["num_questions"],
+            "asked": [],
+            "order": question_order(query, api_hyperparams),
+            "branches": {},
+        }
+    return checkpoint
+
+
+def save_checkpoint(results: Dict, checkpoint: Dict, store: ResultStore, lock=None):
+    """Persist a completed turn, without counting a try"""
+    with lock or nullcontext():
+        results["checkpoint"] = checkpoint
+        store.put(results)
+
+
+def finish_sequential(
+    results: Dict, query: Dict, api_hyperparams: Dict, checkpoint: Dict, prune: bool
+):
+    """Record the conversation of the sequential mode once no question is left"""
+    answers, order = checkpoint["answers"], checkpoint["order"]
+    inferred = [False] * len(answers)
+    for i in order:
+        if answers[i] == -1 and i not in checkpoint["asked"]:
+            # the relations are exclusive, the others do not hold
+            answers[i] = "no"
+            inferred[i] = True
+
+    record_conversation(
+        results, checkpoint["messages"], checkpoint["responses"], answers
+    )
+    if prune:
+        record_yes(query, answers)
+        results["asked"] = checkpoint["asked"]
+        results["inferred"] = inferred
+
+
+def next_question(checkpoint: Dict, prune: bool) -> Optional[int]:
+    """The index of the next relation question to ask, None once the conversation is over"""
+    if prune and "yes" in checkpoint["answers"]:
+        return None
+    for i in checkpoint["order"]:
+        if i not in checkpoint["asked"]:
+            return i
+    return None
+
+
+def send_options(query: Dict) -> Dict:
+    """The keyword arguments of send_prompt for the turns of the query"""
+    return {"route_key": query["doc_name"], "stop_when": first_line_complete}
+
+
+def record_first_turn(results: Dict, checkpoint: Dict, store: ResultStore, response_text: str):
+    checkpoint["responses"].append(response_text)
+    save_checkpoint(results, checkpoint, store)
+
+
+def record_branch(
+    results: Dict, checkpoint: Dict, store: ResultStore, i: int, response_text: str, lock=None
+):
+    checkpoint["branches"][str(i)] = response_text
+    save_checkpoint(results, checkpoint, store, lock=lock)
+
+
+def finish_parallel(
+    results: Dict, checkpoint: Dict, branches: List[List[Dict]], branch_responses: List[str]
+):
+    """Record the conversation of the parallel mode once every branch is answered"""
+    answers = [extract_answer(response.lower()) for response in branch_responses]
+    record_branches(
+        results, branches, checkpoint["responses"][:1] + list(branch_responses), answers
+    )
+
+
+def next_turn(
+    checkpoint: Dict, question_prompts: List[str], prune: bool
+) -> Optional[Tuple[int, List[Dict]]]:
+    """
+    The index of the next relation question and the messages of its turn, None once
+    the conversation is over
+    """
+    i = next_question(checkpoint, prune)
+    if i is None:
+        return None
+    return i, [
+        {"role": "assistant", "content": checkpoint["responses"][-1]},
+        {"role": "user", "content": question_prompts[i]},
+    ]
+
+
+def record_turn(
+    results: Dict,
+    checkpoint: Dict,
+    store: ResultStore,
+    i: int,
+    turn: List[Dict],
+    response_text: str,
+):
+    # the turn joins the saved history only once it is answered
+    checkpoint["messages"].extend(turn)
+    checkpoint["responses"].append(response_text)
+    checkpoint["answers"][i] = extract_answer(response_text.lower())
+    checkpoint["asked"].append(i)
+    save_checkpoint(results, checkpoint, store)
+
+
+def process_query(
+    query: Dict,
+    api_hyperparams: Dict,
+    save_dir: str,
+    max_tries: int = None,
+    enqueued_at: float = None,
+):
+    store, results = start_try(query, api_hyperparams, save_dir, max_tries, enqueued_at)
+    if is_done(results, max_tries):
+        return results
+    request_log = results.setdefault("requests", [])
+
+    try:
+        # every completed turn is saved, a new try continues after the last one
+        checkpoint = load_checkpoint(results, query, api_hyperparams)
+        messages, responses = checkpoint["messages"], checkpoint["responses"]
+
+        if not responses:
+            # print(json.dumps(messages, indent=4))
+            response_text = send_prompt(
+                messages, api_hyperparams, request_log, **send_options(query)
+            )
+            record_first_turn(results, checkpoint, store, response_text)
+
+        question_prompts = follow_up_questions(
+            query["prompt_info"]["question_prompts"], responses[0]
+        )
+
+        if api_hyperparams.get("cot_mode") == "parallel":
+            # the relation questions only depend on the same-event turn
+            branches = branch_messages(messages[:1], responses[0], question_prompts)
+            lock = threading.Lock()
+
+            def ask(i):
+                if str(i) not in checkpoint["branches"]:
+                    response_text = send_prompt(
+                        branches[i], api_hyperparams, request_log, **send_options(query)
+                    )
+                    record_branch(results, checkpoint, store, i, response_text, lock=lock)
+                return checkpoint["branches"][str(i)]
+
+            with ThreadPoolExecutor(max_workers=len(branches)) as executor:
+                branch_responses = list(executor.map(ask, range(len(branches))))
+            finish_parallel(results, checkpoint, branches, branch_responses)
+        else:
+            prune = can_prune(query, api_hyperparams)
+            question = next_turn(checkpoint, question_prompts, prune)
+            while question is not None:
+                i, turn = question
+                response_text = send_prompt(
+                    messages + turn, api_hyperparams, request_log, **send_options(query)
+                )
+                record_turn(results, checkpoint, store, i, turn, response_text)
+                question = next_turn(checkpoint, question_prompts, prune)
+
+            finish_sequential(results, query, api_hyperparams, checkpoint, prune)
+
+    except Exception as ex:
+        record_error(results, ex)
+
+    return save_results(results, store)
+
+
+async def process_query_async(
+    query: Dict,
+    api_hyperparams: Dict,
+    save_dir: str,
+    max_tries: int = None,
+    enqueued_at: float = None,
+):
+    store, results = start_try(query, api_hyperparams, save_dir, max_tries, enqueued_at)
+    if is_done(results, max_tries):
+        return results
+    request_log = results.setdefault("requests", [])
+
+    try:
+        checkpoint = load_checkpoint(results, query, api_hyperparams)
+        messages, responses = checkpoint["messages"], checkpoint["responses"]
+
+        if not responses:
+            response_text = await send_prompt_async(
+                messages, api_hyperparams, request_log, **send_options(query)
+            )
+            record_first_turn(results, checkpoint, store, response_text)
+
+        question_prompts = follow_up_questions(
+            query["prompt_info"]["question_prompts"], responses[0]
+        )
+
+        if api_hyperparams.get("cot_mode") == "parallel":
+            branches = branch_messages(messages[:1], responses[0], question_prompts)
+
+            async def ask(i):
+                if str(i) not in checkpoint["branches"]:
+                    response_text = await send_prompt_async(
+                        branches[i], api_hyperparams, request_log, **send_options(query)
+                    )
+                    record_branch(results, checkpoint, store, i, response_text)
+                return checkpoint["branches"][str(i)]
+
+            branch_responses = await asyncio.gather(*(ask(i) for i in range(len(branches))))
+            finish_parallel(results, checkpoint, branches, branch_responses)
+        else:
+            prune = can_prune(query, api_hyperparams)
+            question = next_turn(checkpoint, question_prompts, prune)
+            while question is not None:
+                i, turn = question
+                response_text = await send_prompt_async(
+                    messages + turn, api_hyperparams, request_log, **send_options(query)
+                )
+                record_turn(results, checkpoint, store, i, turn, response_text)
+                question = next_turn(checkpoint, question_prompts, prune)
+
+            finish_sequential(results, query, api_hyperparams, checkpoint, prune)
+
+    except Exception as ex:
+        record_error(results, ex)
+
+    return save_results(results, store)
@@ -0,0 +1,52 @@
+import json
+import os
+from typing import Dict, List
+
+STRATEGIES = ["batchqa", "cot"]
+# Fields of a configuration that are not API hyperparameters
+CONFIG_FIELDS = {"strategy", "name", "save_path"}
+
+
+def config_name(config: Dict) -> str:
+    """Default name (and results folder) of a configuration"""
+    return f"{config['model'].replace('/', '_')}_{config['strategy']}_{config['temp']}"
+
+
+def load_sweep(path: str, base_hyperparams: Dict, save_path: str) -> List[Dict]:
+    """
+    Read the configurations of a sweep: a JSON list of objects with a model, a
+    strategy and any API hyperparameter to override (url, backend, temp,
+    max_concurrency, ...), optionally a name and a save_path.
+    :param base_hyperparams: The hyperparameters given on the command line, used for
+    everything a configuration does not set
+    :param save_path: The folder of the sweep, each configuration saves its results
+    in a subfolder named after it unless it has its own save_path
+    :return: The configurations, each with its strategy, name, save_path and
+    hyperparameters
+    """
+    with open(path, "r") as file:
+        entries = json.load(file)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path} must contain a non-empty list of configurations")
+
+    configs = []
+    for entry in entries:
+        unknown = set(entry) - CONFIG_FIELDS - set(base_hyperparams)
+        if unknown:
+            raise ValueError(f"Unknown fields in the sweep configuration {entry}: {sorted(unknown)}")
+        if "model" not in entry or "strategy" not in entry:
+            raise ValueError(f"A sweep configuration needs a model and a strategy: {entry}")
+        if entry["strategy"] not in STRATEGIES:
+            raise ValueError(f"Unknown strategy {entry['strategy']}, expected one of {STRATEGIES}")
+
+        hyperparams = dict(base_hyperparams)
+        hyperparams.update({key: value for key, value in entry.items() if key not in CONFIG_FIELDS})
+        config = {"strategy": entry["strategy"], "hyperparams": hyperparams}
+        config["name"] = entry.get("name") or config_name({**hyperparams, **config})
+        config["save_path"] = entry.get("save_path") or os.path.join(save_path, config["name"])
+        configs.append(config)
+
+    save_paths = [config["save_path"] for config in configs]
+    if len(set(save_paths)) != len(save_paths):
+        raise ValueError("Two sweep configurations save their results in the same folder")
+    return configs
@@ -0,0 +1,170 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+from nltk.tokenize import sent_tokenize
+
+from llm_requests.rate_limit import CHARS_PER_TOKEN
+
+# How far (in characters) from its annotated offset an event text is searched for,
+# the loaded text is stripped so the offsets can be slightly off
+OFFSET_TOLERANCE = 100
+# Separator between the non contiguous sentences of a context window
+GAP = "[...]"
+
+
+def split_sentences(doc: str) -> List[Tuple[int, int]]:
+    """
+    :return: The (start, end) character spans of the sentences of the document
+    """
+    try:
+        sentences = sent_tokenize(doc)
+    except LookupError:
+        # punkt models not downloaded, split after sentence final punctuation
+        sentences = re.split(r"(?<=[.!?])\s+", doc)
+
+    spans, cursor = [], 0
+    for sentence in sentences:
+        start = doc.find(sentence, cursor)
+        if start == -1:
+            continue
+        spans.append((start, start + len(sentence)))
+        cursor = start + len(sentence)
+    return spans
+
+
+def locate(doc: str, text: str, offset: Optional[str]) -> Optional[int]:
+    """Position of an event text in the document, closest to its annotated offset"""
+    try:
+        offset = int(offset)
+    except (TypeError, ValueError):
+        position = doc.find(text)
+        return position if position != -1 else None
+
+    window_start = max(0, offset - OFFSET_TOLERANCE)
+    window = doc[window_start : offset + len(text) + OFFSET_TOLERANCE]
+    positions = [m.start() + window_start for m in re.finditer(re.escape(text), window)]
+    if not positions:
+        position = doc.find(text)
+        return position if position != -1 else None
+    return min(positions, key=lambda position: abs(position - offset))
+
+
+def sentence_index(spans: List[Tuple[int, int]], position: Optional[int]) -> Optional[int]:
+    if position is None:
+        return None
+    for i, (start, end) in enumerate(spans):
+        if position < end:
+            return i
+    return len(spans) - 1 if spans else None
+
+
+def section_time_sentences(
+    doc: str, spans: List[Tuple[int, int]], events: Optional[List[Dict]] = None
+) -> List[int]:
+    """
+    :param events: The events of the document from load_data, the admission and
+    discharge dates are the TIMEX3 marked with SECTIME
+    :return: The indices of the sentences with the admission and discharge dates
+    """
+    indices = set()
+    for event in events or []:
+        if event.get("SECTIME"):
+            index = sentence_index(spans, locate(doc, event["text"], event.get("start")))
+            if index is not None:
+                indices.add(index)
+    if not indices:
+        for match in re.finditer(r"(admission|discharge) date", doc, flags=re.IGNORECASE):
+            indices.add(sentence_index(spans, match.start()))
+    return sorted(index for index in indices if index is not None)
+
+
+def build_context(
+    doc: str,
+    pair: Dict,
+    spans: List[Tuple[int, int]],
+    section_times: List[int],
+    token_budget: int,
+) -> str:
+    """
+    Excerpt of the document for a pair: the sentences from the first to the last
+    event of the pair, the admission/discharge date sentences and as many of the
+    surrounding sentences as fit in the token budget.
+    """
+    from_index = sentence_index(spans, locate(doc, pair["fromText"], pair["fromStart"]))
+    to_index = sentence_index(spans, locate(doc, pair["toText"], pair["toStart"]))
+    indices = [index for index in [from_index, to_index] if index is not None]
+    if not spans or not indices:
+        # the events could not be found, fall back to the whole document
+        return doc
+
+    def num_tokens(index):
+        start, end = spans[index]
+        return (end - start + 1) // CHARS_PER_TOKEN + 1
+
+    first, last = min(indices), max(indices)
+    selected = set(range(first, last + 1)) | set(section_times)
+    used = sum(num_tokens(index) for index in selected)
+
+    # grow the window around the pair one sentence at a time on each side,
+    # a side stops at the first sentence that does not fit in the budget
+    left, right = first - 1, last + 1
+    while left >= 0 or right < len(spans):
+        for side in ["left", "right"]:
+            index = left if side == "left" else right
+            if not 0 <= index < len(spans):
+                continue
+            if index not in selected:
+                if used + num_tokens(index) > token_budget:
+                    index = -1 if side == "left" else len(spans)
+                else:
+                    selected.add(index)
+                    used += num_tokens(index)
+            if side == "left":
+                left = index - 1
+            else:
+                right = index + 1
+
+    pieces, previous = [], None
+    for index in sorted(selected):
+        if previous is not None and index != previous + 1:
+            pieces.append(GAP)
+        start, end = spans[index]
+        pieces.append(doc[start:end])
+        previous = index
+    return " ".join(pieces)
+
+
+def document_sentences(
+    doc: str, events: Optional[List[Dict]] = None
+) -> Tuple[List[Tuple[int, int]], List[int]]:
+    """:return: The sentence spans of the document and the indices of its section time sentences"""
+    spans = split_sentences(doc)
+    return spans, section_time_sentences(doc, spans, events)
+
+
+def pair_contexts(
+    doc: str,
+    candidate_pairs: List[Dict],
+    token_budget: int,
+    events: Optional[List[Dict]] = None,
+) -> List[str]:
+    """
+    :param token_budget: Approximate number of tokens of each context
+    :return: The excerpt of the document given as context for each pair
+    """
+    spans, section_times = document_sentences(doc, events)
+    return [
+        build_context(doc, pair, spans, section_times, token_budget)
+        for pair in candidate_pairs
+    ]
+
+
+def summarize_reduction(prompts: List[Dict]) -> Dict:
+    """Estimated prompt tokens of the document contexts, full vs windowed"""
+    full = sum(query["doc_length"] for query in prompts) // CHARS_PER_TOKEN
+    windowed = sum(query["context_length"] for query in prompts) // CHARS_PER_TOKEN
+    return {
+        "full_tokens": full,
+        "windowed_tokens": windowed,
+        "reduction": full / windowed if windowed else 0.0,
+    }
@@ -1,25 +1,34 @@
 import argparse
 import os
-from typing import Dict
-
-from multiprocessing import Pool
+import time
+from functools import partial
+from itertools import islice
+from typing import Callable, Dict, List, Tuple
 
+from llm_requests.backends import BACKENDS
+from llm_requests.batch import check_batch_support, export_batch, import_batch
 from llm_requests.data import get_xml_files, load_data, load_pairs
+from llm_requests.doc_table import DocumentTable, make_ref, process_ref
+from llm_requests.engine import run_async, run_interleaved, run_pool
+from llm_requests.estimate import estimate_run, project_run
+from llm_requests.metrics import latest_records, save_run_summary, summarize_run
+from llm_requests.rate_limit import RateLimiter
+from llm_requests.retry import DEFAULT_MAX_TRIES, RetryQueue
+from llm_requests.scheduling import in_shard, order_by_document, parse_shard
+from llm_requests.store import STORES, Manifest, get_store
+from llm_requests.sweep import load_sweep
+from llm_requests.windowing import summarize_reduction
 
 import llm_requests.strategies.batchqa as batchqa
 import llm_requests.strategies.cot as cot
 
 
-def main(
-    data_path: str,
-    pairs_path: str,
-    save_path: str,
-    strategy: str,
-    curr_relations_schema: Dict,
-    API_HYPERPARAMS: Dict,
-    debug: bool = False,
-):
-
+def load_corpus(
+    data_path: str, pairs_path: str, debug: bool = False
+) -> Tuple[List[str], List[str], List[List[Dict]], List[List[Dict]]]:
+    """
+    :return: The names, texts, events and candidate pairs of the documents
+    """
     # Load data
     print("Loading data")
     # Get filenames
@@ -39,47 +48,473 @@ def main(
     assert len(files) == len(texts) == len(events) == len(tlinks)
 
     union_pairs = load_pairs(pairs_path, files)
+    return file_ids, texts, events, union_pairs
+
 
+def select_strategy(
+    strategy: str, pairs_per_prompt: int = 1, pack_tokens: int = None
+) -> Tuple[Callable, Callable, Callable]:
+    """
+    :return: The prompt generator, and the synchronous and asynchronous query
+    functions of the strategy
+    """
     if strategy == "batchqa":
-        generate_prompt = batchqa.generate_prompt
+        iter_prompts = batchqa.iter_prompts
         process_query = batchqa.process_query
+        process_query_async = batchqa.process_query_async
+        if pairs_per_prompt > 1:
+            iter_prompts = partial(
+                batchqa.iter_prompts,
+                pairs_per_prompt=pairs_per_prompt,
+                pack_tokens=pack_tokens,
+            )
+            process_query = batchqa.process_pack
+            process_query_async = batchqa.process_pack_async
     elif strategy == "cot":
-        generate_prompt = cot.generate_prompt
+        iter_prompts = cot.iter_prompts
         process_query = cot.process_query
+        process_query_async = cot.process_query_async
+    else:
+        raise ValueError(f"Unknown strategy {strategy}, expected batchqa or cot")
+    return iter_prompts, process_query, process_query_async
 
-    print("Generating prompts")
-    all_prompts = []
-    for i in range(len(texts)):
-        prompts = generate_prompt(
-            doc_name=file_ids[i],
-            doc=texts[i],
-            candidate_pairs=union_pairs[i],
-            relations_scheme=curr_relations_schema,
+
+def check_options(
+    strategy: str,
+    API_HYPERPARAMS: Dict,
+    mode: str = "query",
+    context_tokens: int = None,
+    pairs_per_prompt: int = 1,
+):
+    if pairs_per_prompt > 1:
+        if strategy != "batchqa":
+            raise ValueError("Only the batchqa strategy can ask several pairs per prompt")
+        if context_tokens:
+            # the pairs of a prompt share the document, not their context windows
+            raise ValueError("--pairs_per_prompt cannot be combined with --context_tokens")
+        if mode != "query":
+            raise ValueError("Batch jobs are exported with one pair per prompt")
+    if (
+        API_HYPERPARAMS.get("cot_prune", "none") != "none"
+        and API_HYPERPARAMS.get("cot_mode") == "parallel"
+    ):
+        raise ValueError("--cot_prune needs the sequential --cot_mode")
+
+
+def print_summary(summary: Dict):
+    print(
+        f"{summary['requests']} requests in {summary['wall_time']:.1f}s, "
+        f"{summary['requests_per_sec']:.2f} requests/sec, "
+        f"{summary['tokens_per_sec']:.1f} tokens/sec "
+        f"({summary['completion_tokens_per_sec']:.1f} completion), "
+        f"latency p50/p95/p99: {summary['latency_p50'] or 0:.3f}/"
+        f"{summary['latency_p95'] or 0:.3f}/{summary['latency_p99'] or 0:.3f}s"
+    )
+    if summary["hedges_fired"]:
+        print(
+            f"{summary['hedges_fired']} hedged requests, {summary['hedges_won']} won, "
+            f"{summary['hedge_saved']:.1f}s saved (estimated)"
+        )
+
+
+def report_failures(report: Dict, save_path: str):
+    """Print the retries of the run and save the queries that failed for good"""
+    retried = {error_class: count for error_class, count in report["retries"].items() if count}
+    if retried:
+        print(
+            "Retried "
+            + ", ".join(f"{count} {error_class}" for error_class, count in retried.items())
+            + " failures"
+        )
+    save_run_summary(report, save_path, filename="failed_queries.json")
+    if report["failed"]:
+        print(
+            f"{report['failed']} queries failed after their retries ("
+            + ", ".join(
+                f"{count} {error_class}"
+                for error_class, count in report["failed_by_class"].items()
+            )
+            + f"), see {os.path.join(save_path, 'failed_queries.json')}"
         )
-        all_prompts.extend(prompts)
+        for unique_id, failure in report["failed_queries"].items():
+            print(f"  {unique_id}: {failure['error_class']} after {failure['num_tries']} tries")
+
+
+def main(
+    data_path: str,
+    pairs_path: str,
+    save_path: str,
+    strategy: str,
+    curr_relations_schema: Dict,
+    API_HYPERPARAMS: Dict,
+    debug: bool = False,
+    engine: str = "pool",
+    doc_window: int = 0,
+    mode: str = "query",
+    batch_file: str = None,
+    context_tokens: int = None,
+    pairs_per_prompt: int = 1,
+    pack_tokens: int = None,
+    shard: str = None,
+    shard_by_document: bool = False,
+    dry_run: bool = False,
+    prices: Tuple[float, float] = (None, None),
+    throughput: float = None,
+    max_tries: int = DEFAULT_MAX_TRIES,
+):
+
+    file_ids, texts, events, union_pairs = load_corpus(data_path, pairs_path, debug)
+
+    check_options(strategy, API_HYPERPARAMS, mode, context_tokens, pairs_per_prompt)
+
+    iter_prompts, process_query, process_query_async = select_strategy(
+        strategy, pairs_per_prompt, pack_tokens
+    )
+
+    # With the pool engine the workers rebuild the queries from a shared read-only
+    # table of the documents, and the tasks only carry a reference to their query
+    use_table = engine == "pool" and mode == "query" and not dry_run
+
+    tmp_path = os.path.join(save_path, "tmp")
+    print(tmp_path)
+    os.makedirs(tmp_path, exist_ok=True)
+
+    # Resume: the state of the saved queries is read once, and only the queries
+    # with work left are dispatched
+    manifest = None
+    if mode == "query":
+        manifest = Manifest.load(API_HYPERPARAMS.get("store") or "json", tmp_path, max_tries)
+        if manifest.statuses:
+            resumed = manifest.summary()
+            print(
+                f"Resuming from {resumed['saved']} saved queries: {resumed['finished']} "
+                f"finished, {resumed['exhausted']} out of tries, {resumed['retried']} to retry"
+            )
+
+    # The prompts are generated while the queries run, only their sizes are kept
+    prompt_sizes = []
+
+    shard_index, shard_count = parse_shard(shard) if shard else (0, 1)
+
+    def iter_all_prompts():
+        for i in range(len(texts)):
+            if shard_by_document and not in_shard(file_ids[i], shard_index, shard_count):
+                continue
+            prompts = iter_prompts(
+                doc_name=file_ids[i],
+                doc=texts[i],
+                candidate_pairs=union_pairs[i],
+                relations_scheme=curr_relations_schema,
+                events=events[i],
+                context_tokens=context_tokens,
+            )
+            for query_idx, prompt in enumerate(prompts):
+                if not shard_by_document and not in_shard(
+                    prompt["unique_id"], shard_index, shard_count
+                ):
+                    continue
+                if manifest is not None and not manifest.should_dispatch(prompt):
+                    continue
+                prompt_sizes.append(
+                    {
+                        "doc_length": prompt["doc_length"],
+                        "context_length": prompt["context_length"],
+                    }
+                )
+                yield make_ref(prompt, query_idx) if use_table else prompt
+
+    all_prompts = iter_all_prompts()
+
+    if doc_window:
+        # Keep the queries of a few documents together so that the server can reuse
+        # the cached document prefix of their prompts
+        all_prompts = order_by_document(all_prompts, doc_window)
 
     # if strategy == "batchqa":
     #     process_query = batchqa.process_query
     # elif strategy == "cot":
     #     process_query = cot.process_query
 
-    tmp_path = os.path.join(save_path, "tmp")
-    print(tmp_path)
-    os.makedirs(tmp_path, exist_ok=True)
-    args_list = [(prompt, API_HYPERPARAMS, tmp_path, 2) for prompt in all_prompts]
+    if dry_run:
+        # Count the tokens of the run instead of sending it
+        estimate = estimate_run(all_prompts, strategy, API_HYPERPARAMS)
+        estimate.update(
+            project_run(
+                estimate,
+                price_input=prices[0],
+                price_output=prices[1],
+                requests_per_sec=throughput,
+                rpm=API_HYPERPARAMS.get("rpm"),
+                tpm=API_HYPERPARAMS.get("tpm"),
+            )
+        )
+        save_run_summary(estimate, save_path, filename="dry_run.json")
+        print(f"Tokens counted with {estimate['tokenizer']}")
+        pruned = strategy == "cot" and API_HYPERPARAMS.get("cot_prune", "none") != "none"
+        print(
+            f"{estimate['queries']} queries, {estimate['requests']} requests"
+            f"{' at most, as --cot_prune skips questions' if pruned else ''}"
+        )
+        print(
+            f"{estimate['prompt_tokens']} prompt tokens, per request p50/p90/p99/max: "
+            f"{estimate['prompt_tokens_p50'] or 0:.0f}/{estimate['prompt_tokens_p90'] or 0:.0f}/"
+            f"{estimate['prompt_tokens_p99'] or 0:.0f}/{estimate['prompt_tokens_max'] or 0}"
+        )
+        print(f"{estimate['completion_tokens']} completion tokens (estimated)")
+        if estimate["cost"] is not None:
+            print(f"Estimated cost: {estimate['cost']:.2f}")
+        if estimate["duration"] is not None:
+            print(f"Estimated duration: {estimate['duration'] / 60:.1f} minutes")
+        return
+
+    if mode == "batch-export":
+        check_batch_support(strategy, API_HYPERPARAMS)
+        batch_file = batch_file or os.path.join(save_path, "batch_requests.jsonl")
+        num_requests = export_batch(all_prompts, API_HYPERPARAMS, batch_file)
+        print(f"Exported {num_requests} requests to {batch_file}")
+        return
+    elif mode == "batch-import":
+        check_batch_support(strategy, API_HYPERPARAMS)
+        if batch_file is None:
+            raise ValueError("--batch_file with the results of the batch job is required")
+        store = get_store(API_HYPERPARAMS, tmp_path)
+        results = import_batch(list(all_prompts), batch_file, store, max_tries=max_tries)
+        store.close()
+        num_finished = sum(1 for result in results if result["finished"])
+        print(f"Imported {len(results)} results from {batch_file}, {num_finished} finished")
+        return
+
+    table = None
+    if use_table:
+        settings = {"relations_scheme": curr_relations_schema, "context_tokens": context_tokens}
+        if pairs_per_prompt > 1:
+            settings.update(pairs_per_prompt=pairs_per_prompt, pack_tokens=pack_tokens)
+        table = DocumentTable.build(
+            os.path.join(save_path, "document_table.bin"),
+            file_ids,
+            texts,
+            events,
+            union_pairs,
+            strategy=strategy,
+            settings=settings,
+        )
+        process_query = partial(process_ref, process_query)
+
+    run_start = time.time()
+    # enqueued_at is the time each query is handed to the engine
+    args_list = (
+        (prompt, API_HYPERPARAMS, tmp_path, max_tries, time.time()) for prompt in all_prompts
+    )
     if debug:
-        args_list = args_list[:6]
+        args_list = islice(args_list, 6)
 
-    print(f"Starting {len(args_list)} queries")
-    num_processes = 3 if debug else API_HYPERPARAMS["num_processes"]
-    with Pool(processes=num_processes) as pool:
-        results = pool.starmap(process_query, args_list)
+    # Shared request/token budget for hosted models
+    limiter = None
+    if API_HYPERPARAMS.get("rpm") or API_HYPERPARAMS.get("tpm"):
+        limiter = RateLimiter(rpm=API_HYPERPARAMS["rpm"], tpm=API_HYPERPARAMS["tpm"])
+
+    # The failed queries are tried again within the run, with a backoff
+    retries = RetryQueue(max_tries)
+
+    print("Starting the queries")
+    if engine == "async":
+        results = run_async(
+            process_query_async,
+            args_list,
+            API_HYPERPARAMS,
+            max_in_flight=API_HYPERPARAMS["max_in_flight"],
+            limiter=limiter,
+            retries=retries,
+        )
+    else:
+        num_processes = 3 if debug else API_HYPERPARAMS["num_processes"]
+        results = run_pool(
+            process_query,
+            args_list,
+            API_HYPERPARAMS,
+            num_processes,
+            limiter=limiter,
+            table=table,
+            retries=retries,
+        )
+
+    # one list of pair records per packed prompt, one record per try of a query
+    results = latest_records(results)
 
     print("Finished the queries")
+    if manifest is not None and manifest.skipped:
+        print(
+            f"Skipped {manifest.skipped} queries with no work left, "
+            f"dispatched {manifest.dispatched}"
+        )
+    if context_tokens or pairs_per_prompt > 1:
+        reduction = summarize_reduction(prompt_sizes)
+        print(
+            f"Document context of the prompts: {reduction['windowed_tokens']} tokens "
+            f"instead of {reduction['full_tokens']} (estimated, "
+            f"{reduction['reduction']:.1f}x fewer)"
+        )
     print(f"Saving {len(results)} results")
+
+    summary = summarize_run(
+        results,
+        run_start=run_start,
+        wall_time=time.time() - run_start,
+        model=API_HYPERPARAMS["model"],
+        strategy=strategy,
+    )
+    save_run_summary(summary, save_path)
+    print_summary(summary)
+    report_failures(retries.report(), save_path)
     # print(results)
 
 
+def sweep(
+    data_path: str,
+    pairs_path: str,
+    save_path: str,
+    sweep_path: str,
+    curr_relations_schema: Dict,
+    API_HYPERPARAMS: Dict,
+    debug: bool = False,
+    doc_window: int = 0,
+    context_tokens: int = None,
+    pairs_per_prompt: int = 1,
+    pack_tokens: int = None,
+    shard: str = None,
+    shard_by_document: bool = False,
+    max_tries: int = DEFAULT_MAX_TRIES,
+):
+    """
+    Run several configurations (model, backend, strategy, temperature) in one go:
+    the corpus is loaded once and each configuration generates its prompts lazily
+    as its own job of the async engine, with the concurrency limit of its backend,
+    so that a slow backend does not pace the others. Each configuration keeps its
+    own results, resume state and run summary in its save path. Each configuration
+    has its own concurrency limit and request/token budget, the ones of the same
+    model and server share it.
+    """
+    configs = load_sweep(sweep_path, API_HYPERPARAMS, save_path)
+    for config in configs:
+        check_options(
+            config["strategy"],
+            config["hyperparams"],
+            context_tokens=context_tokens,
+            pairs_per_prompt=pairs_per_prompt if config["strategy"] == "batchqa" else 1,
+        )
+
+    file_ids, texts, events, union_pairs = load_corpus(data_path, pairs_path, debug)
+
+    process_fns, manifests = [], []
+    for config in configs:
+        config["tmp_path"] = os.path.join(config["save_path"], "tmp")
+        os.makedirs(config["tmp_path"], exist_ok=True)
+        _, _, process_query_async = select_strategy(
+            config["strategy"],
+            pairs_per_prompt if config["strategy"] == "batchqa" else 1,
+            pack_tokens,
+        )
+        process_fns.append(process_query_async)
+        manifest = Manifest.load(
+            config["hyperparams"].get("store") or "json", config["tmp_path"], max_tries
+        )
+        if manifest.statuses:
+            resumed = manifest.summary()
+            print(
+                f"{config['name']}: resuming from {resumed['saved']} saved queries, "
+                f"{resumed['finished']} finished"
+            )
+        manifests.append(manifest)
+
+    shard_index, shard_count = parse_shard(shard) if shard else (0, 1)
+
+    def iter_strategy_prompts(strategy: str):
+        iter_prompts, _, _ = select_strategy(
+            strategy, pairs_per_prompt if strategy == "batchqa" else 1, pack_tokens
+        )
+        for i in range(len(texts)):
+            if shard_by_document and not in_shard(file_ids[i], shard_index, shard_count):
+                continue
+            prompts = iter_prompts(
+                doc_name=file_ids[i],
+                doc=texts[i],
+                candidate_pairs=union_pairs[i],
+                relations_scheme=curr_relations_schema,
+                events=events[i],
+                context_tokens=context_tokens,
+            )
+            for prompt in prompts:
+                if shard_by_document or in_shard(prompt["unique_id"], shard_index, shard_count):
+                    yield prompt
+
+    def iter_tasks(job: int):
+        # the prompts the configuration still has work for
+        config = configs[job]
+        prompts = iter_strategy_prompts(config["strategy"])
+        if doc_window:
+            prompts = order_by_document(prompts, doc_window)
+        for prompt in prompts:
+            if manifests[job].should_dispatch(prompt):
+                yield prompt, config["hyperparams"], config["tmp_path"], max_tries, time.time()
+
+    tasks = [iter_tasks(job) for job in range(len(configs))]
+    if debug:
+        tasks = [islice(job_tasks, 6) for job_tasks in tasks]
+
+    # The configurations of the same model on the same server share its budget
+    limiters, budgets = [], {}
+    for config in configs:
+        hyperparams = config["hyperparams"]
+        limiter = None
+        if hyperparams.get("rpm") or hyperparams.get("tpm"):
+            budget = (
+                hyperparams.get("backend"),
+                hyperparams.get("url"),
+                hyperparams["model"],
+                hyperparams.get("rpm"),
+                hyperparams.get("tpm"),
+            )
+            if budget not in budgets:
+                budgets[budget] = RateLimiter(
+                    rpm=hyperparams.get("rpm"), tpm=hyperparams.get("tpm")
+                )
+            limiter = budgets[budget]
+        limiters.append(limiter)
+
+    retries = [RetryQueue(max_tries) for _ in configs]
+
+    print(f"Starting the queries of {len(configs)} configurations")
+    run_start = time.time()
+    all_results, wall_times = run_interleaved(
+        process_fns,
+        tasks,
+        [config["hyperparams"] for config in configs],
+        limits=[config["hyperparams"]["max_in_flight"] for config in configs],
+        limiters=limiters,
+        retries=retries,
+    )
+    print("Finished the queries")
+
+    for config, manifest, results, wall_time, job_retries in zip(
+        configs, manifests, all_results, wall_times, retries
+    ):
+        results = latest_records(results)
+        summary = summarize_run(
+            results,
+            run_start=run_start,
+            wall_time=wall_time,
+            model=config["hyperparams"]["model"],
+            strategy=config["strategy"],
+        )
+        save_run_summary(summary, config["save_path"])
+        print(
+            f"{config['name']}: {len(results)} results saved in {config['tmp_path']}, "
+            f"{manifest.skipped} skipped"
+        )
+        print_summary(summary)
+        report_failures(job_retries.report(), config["save_path"])
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -104,7 +539,24 @@ if __name__ == "__main__":
         "--strategy", type=str, help="Strategy to use: batchqa or cot", default="batchqa"
     )
     parser.add_argument(
-        "--url", type=str, help="URL for the model", default="http://localhost:8000/"
+        "--url",
+        type=str,
+        help="URL for the model, or comma separated URLs of its replicas "
+        "(not used by the hosted openai backend)",
+        default="http://localhost:8000/",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        help="Backend serving the model (default: inferred from the model name)",
+        choices=list(BACKENDS.keys()),
+        default=None,
+    )
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        help="Maximum concurrent requests for the backend (default: the backend's own limit)",
+        default=None,
     )
     parser.add_argument(
         "--save_path", type=str, help="Path to save the results", default="batchqa"
@@ -112,6 +564,215 @@ if __name__ == "__main__":
     parser.add_argument(
         "--num_processes", type=int, help="Number of processes to use", default=150
     )
+    parser.add_argument(
+        "--pool_size",
+        type=int,
+        help="Maximum number of keep-alive connections per client in each process",
+        default=10,
+    )
+    parser.add_argument(
+        "--timeout", type=float, help="Request timeout in seconds", default=600.0
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        help="Execution engine: pool (one process per worker) or async (one event loop)",
+        choices=["pool", "async"],
+        default="pool",
+    )
+    parser.add_argument(
+        "--max_in_flight",
+        type=int,
+        help="Maximum number of concurrent requests for the async engine",
+        default=1000,
+    )
+    parser.add_argument(
+        "--rpm",
+        type=float,
+        help="Requests per minute budget shared by all workers (default: unlimited)",
+        default=None,
+    )
+    parser.add_argument(
+        "--tpm",
+        type=float,
+        help="Tokens per minute budget shared by all workers (default: unlimited)",
+        default=None,
+    )
+    parser.add_argument(
+        "--stub_latency",
+        type=float,
+        help="Seconds the stub backend waits before each response",
+        default=0.0,
+    )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        help="query: send the requests, batch-export: write them to a batch job file, "
+        "batch-import: read the results of a batch job",
+        choices=["query", "batch-export", "batch-import"],
+        default="query",
+    )
+    parser.add_argument(
+        "--batch_file",
+        type=str,
+        help="Batch job file to export (default: batch_requests.jsonl in the save path) "
+        "or batch results file to import",
+        default=None,
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream the responses and stop the generation once all answers are parsed",
+    )
+    parser.add_argument(
+        "--health_interval",
+        type=float,
+        help="Seconds between health probes of the replicas given in --url (0: no probes)",
+        default=10.0,
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        help="Seconds after which a request fails if no response arrived (default: none)",
+        default=None,
+    )
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        help="Send a duplicate of the requests slower than the --hedge_quantile latency "
+        "and keep the first response",
+    )
+    parser.add_argument(
+        "--hedge_quantile",
+        type=float,
+        help="Latency percentile after which a request is hedged",
+        default=95,
+    )
+    parser.add_argument(
+        "--hedge_after",
+        type=float,
+        help="Fixed delay in seconds after which a request is hedged (overrides the quantile)",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache_path",
+        type=str,
+        help="SQLite file of the response cache shared across runs (default: no cache)",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache_max_entries",
+        type=int,
+        help="Maximum number of cached responses, the least recently used are evicted",
+        default=1000000,
+    )
+    parser.add_argument(
+        "--doc_window",
+        type=int,
+        help="Number of documents queried at the same time, so that their prompt "
+        "prefix stays in the server's cache (default: 0, no ordering)",
+        default=0,
+    )
+    parser.add_argument(
+        "--context_tokens",
+        type=int,
+        help="Give only the sentences around each pair and the admission/discharge dates, "
+        "up to about this many tokens, instead of the whole document (default: whole document)",
+        default=None,
+    )
+    parser.add_argument(
+        "--pairs_per_prompt",
+        type=int,
+        help="Number of pairs of a document asked in the same batchqa prompt, so that "
+        "the document is sent once for all of them (default: 1)",
+        default=1,
+    )
+    parser.add_argument(
+        "--pack_tokens",
+        type=int,
+        help="Maximum estimated tokens of a prompt with several pairs (default: no limit)",
+        default=None,
+    )
+    parser.add_argument(
+        "--cot_mode",
+        type=str,
+        help="cot strategy: ask the relation questions one after the other in the same "
+        "conversation (sequential) or all at once after the same-event answer (parallel)",
+        choices=["sequential", "parallel"],
+        default="sequential",
+    )
+    parser.add_argument(
+        "--cot_prune",
+        type=str,
+        help="Sequential cot strategy: stop asking once a relation is answered yes, as "
+        "the relations are exclusive (stop), also asking first the relations answered "
+        "yes most often so far (ordered), or always ask all of them (none)",
+        choices=["none", "stop", "ordered"],
+        default="none",
+    )
+    parser.add_argument(
+        "--store",
+        type=str,
+        help="Where the results are saved in the tmp folder of the save path: one json "
+        "file per query (json) or a single SQLite database, results.db (sqlite)",
+        choices=list(STORES.keys()),
+        default="json",
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        help="Run only the shard i/N of the queries (e.g. 0/4), to split a run across "
+        "machines; merge the results with merge_results.py",
+        default=None,
+    )
+    parser.add_argument(
+        "--shard_by_document",
+        action="store_true",
+        help="Shard by document instead of by query, so that all the queries of a "
+        "document go to the same machine (and server prefix cache)",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Generate the prompts and report the requests and tokens the run would send, "
+        "with its cost and duration if --price_input/--price_output and --throughput "
+        "(or --rpm/--tpm) are given, without sending anything",
+    )
+    parser.add_argument(
+        "--price_input",
+        type=float,
+        help="Dry run: price of a million prompt tokens",
+        default=None,
+    )
+    parser.add_argument(
+        "--price_output",
+        type=float,
+        help="Dry run: price of a million completion tokens",
+        default=None,
+    )
+    parser.add_argument(
+        "--throughput",
+        type=float,
+        help="Dry run: expected requests per second of the server",
+        default=None,
+    )
+    parser.add_argument(
+        "--max_tries",
+        type=int,
+        help="Maximum tries of a query; the failed queries are retried within the run "
+        "with a backoff, as many times as the class of their error allows "
+        "(see llm_requests/retry.py)",
+        default=DEFAULT_MAX_TRIES,
+    )
+    parser.add_argument(
+        "--sweep",
+        type=str,
+        help="JSON file with a list of configurations (model, strategy, url, backend, "
+        "temp, max_concurrency, ...) to run together on the async engine, sharing the "
+        "data loading and prompt generation; each saves its results in a subfolder of "
+        "the save path (the other options are the defaults of every configuration)",
+        default=None,
+    )
     parser.add_argument("--debug", type=bool, help="Debug mode", default=False)
     # num processes
     args = parser.parse_args()
@@ -126,8 +787,27 @@ if __name__ == "__main__":
     API_HYPERPARAMS = {
         "model": args.model,
         "url": args.url,
+        "backend": args.backend,
+        "max_concurrency": args.max_concurrency,
+        "stub_latency": args.stub_latency,
+        "stream": args.stream,
+        "cot_mode": args.cot_mode,
+        "cot_prune": args.cot_prune,
+        "store": args.store,
+        "health_interval": args.health_interval,
+        "deadline": args.deadline,
+        "hedge": args.hedge,
+        "hedge_quantile": args.hedge_quantile,
+        "hedge_after": args.hedge_after,
+        "cache_path": args.cache_path,
+        "cache_max_entries": args.cache_max_entries,
         "temp": args.temp,
         "num_processes": args.num_processes,
+        "pool_size": args.pool_size,
+        "timeout": args.timeout,
+        "max_in_flight": args.max_in_flight,
+        "rpm": args.rpm,
+        "tpm": args.tpm,
     }
 
     curr_relations_schema = [
@@ -138,12 +818,45 @@ if __name__ == "__main__":
         "SIMULTANEOUS",
     ]
 
-    main(
-        data_path=data_path,
-        pairs_path=pairs_path,
-        save_path=args.save_path,
-        strategy=args.strategy,
-        curr_relations_schema=curr_relations_schema,
-        API_HYPERPARAMS=API_HYPERPARAMS,
-        debug=args.debug,
-    )
+    if args.sweep:
+        if args.dry_run or args.mode != "query":
+            parser.error("--sweep only sends the queries, without --dry_run or --mode")
+        sweep(
+            data_path=data_path,
+            pairs_path=pairs_path,
+            save_path=args.save_path,
+            sweep_path=args.sweep,
+            curr_relations_schema=curr_relations_schema,
+            API_HYPERPARAMS=API_HYPERPARAMS,
+            debug=args.debug,
+            doc_window=args.doc_window,
+            context_tokens=args.context_tokens,
+            pairs_per_prompt=args.pairs_per_prompt,
+            pack_tokens=args.pack_tokens,
+            shard=args.shard,
+            shard_by_document=args.shard_by_document,
+            max_tries=args.max_tries,
+        )
+    else:
+        main(
+            data_path=data_path,
+            pairs_path=pairs_path,
+            save_path=args.save_path,
+            strategy=args.strategy,
+            curr_relations_schema=curr_relations_schema,
+            API_HYPERPARAMS=API_HYPERPARAMS,
+            debug=args.debug,
+            engine=args.engine,
+            doc_window=args.doc_window,
+            mode=args.mode,
+            batch_file=args.batch_file,
+            context_tokens=args.context_tokens,
+            pairs_per_prompt=args.pairs_per_prompt,
+            pack_tokens=args.pack_tokens,
+            shard=args.shard,
+            shard_by_document=args.shard_by_document,
+            dry_run=args.dry_run,
+            prices=(args.price_input, args.price_output),
+            throughput=args.throughput,
+            max_tries=args.max_tries,
+        )
@@ -0,0 +1,157 @@
+import argparse
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Set
+
+from llm_requests.store import STORES, open_store
+
+
+def expected_ids(pairs_path: str, exclude: List[str]) -> Set[str]:
+    """The unique_ids of all the candidate pairs, as generated by main.py"""
+    root = ET.parse(pairs_path).getroot()
+    unique_ids = set()
+    for report in root.findall("Report"):
+        if report.attrib["filename"] in exclude:
+            continue
+        doc_name = report.attrib["filename"].replace(".xml", "")
+        for pair in report.findall("Pair"):
+            unique_ids.add(f"{doc_name}_{pair.attrib['fromID']}_{pair.attrib['toID']}")
+    return unique_ids
+
+
+def better(results: Dict, other: Dict) -> bool:
+    """Whether a record of a query should replace the one of another shard"""
+    if results["finished"] != other["finished"]:
+        return results["finished"]
+    return results["num_tries"] > other["num_tries"]
+
+
+def merge(
+    inputs: List[str],
+    output: str,
+    store: str = "json",
+    output_store: str = None,
+    pairs_path: str = None,
+    exclude: List[str] = None,
+) -> Dict:
+    """
+    Combine the result stores of the shards of a run into one store. A query found
+    in several shards keeps its finished record (or the one with the most tries).
+    :return: The completeness report of the merged results
+    """
+    merged = {}
+    overlaps, conflicts = [], []
+    per_input = {}
+    for path in inputs:
+        shard_store = open_store(store, path)
+        per_input[path] = 0
+        for results in shard_store:
+            unique_id = results["query"]["unique_id"]
+            per_input[path] += 1
+            if unique_id in merged:
+                overlaps.append(unique_id)
+                previous = merged[unique_id]
+                if (
+                    results["finished"]
+                    and previous["finished"]
+                    and results["answers"] != previous["answers"]
+                ):
+                    conflicts.append(unique_id)
+                if not better(results, previous):
+                    continue
+            merged[unique_id] = results
+        shard_store.close()
+
+    out_store = open_store(output_store or store, output)
+    for results in merged.values():
+        out_store.put(results)
+    out_store.close()
+
+    report = {
+        "inputs": per_input,
+        "merged": len(merged),
+        "finished": sum(1 for results in merged.values() if results["finished"]),
+        "overlaps": sorted(set(overlaps)),
+        "conflicts": sorted(set(conflicts)),
+        "unfinished": sorted(
+            unique_id for unique_id, results in merged.items() if not results["finished"]
+        ),
+    }
+    if pairs_path:
+        expected = expected_ids(pairs_path, exclude or [])
+        report["expected"] = len(expected)
+        report["missing"] = sorted(expected - set(merged))
+        report["unexpected"] = sorted(set(merged) - expected)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Merge the result stores of the shards of a run (see --shard in main.py)"
+    )
+    parser.add_argument(
+        "--inputs",
+        type=str,
+        nargs="+",
+        help="The result folders of the shards (save_path/tmp of each run)",
+        required=True,
+    )
+    parser.add_argument(
+        "--output", type=str, help="The result folder of the merged run", required=True
+    )
+    parser.add_argument(
+        "--store",
+        type=str,
+        help="Result store of the shards",
+        choices=list(STORES.keys()),
+        default="json",
+    )
+    parser.add_argument(
+        "--output_store",
+        type=str,
+        help="Result store of the merged run (default: the one of the shards)",
+        choices=list(STORES.keys()),
+        default=None,
+    )
+    parser.add_argument(
+        "--pairs_path",
+        type=str,
+        help="The gold_and_candidate_pairs.xml file, to report the missing queries",
+        default=None,
+    )
+    parser.add_argument(
+        "--exclude",
+        type=str,
+        nargs="*",
+        help="Reports left out of the runs",
+        # main.py always leaves it out
+        default=["31.xml"],
+    )
+    args = parser.parse_args()
+
+    report = merge(
+        inputs=args.inputs,
+        output=args.output,
+        store=args.store,
+        output_store=args.output_store,
+        pairs_path=args.pairs_path,
+        exclude=args.exclude,
+    )
+
+    for path, count in report["inputs"].items():
+        print(f"{path}: {count} results")
+    print(f"Merged {report['merged']} results, {report['finished']} finished")
+    print(
+        f"{len(report['overlaps'])} queries in several shards, "
+        f"{len(report['conflicts'])} with different answers"
+    )
+    for unique_id in report["conflicts"]:
+        print(f"  conflicting answers: {unique_id}")
+    print(f"{len(report['unfinished'])} unfinished")
+    if "missing" in report:
+        complete = report["expected"] - len(report["missing"])
+        print(
+            f"{complete}/{report['expected']} expected queries present, "
+            f"{len(report['missing'])} missing, {len(report['unexpected'])} unexpected"
+        )
+        for unique_id in report["missing"]:
+            print(f"  missing: {unique_id}")
@@ -1,13 +1,14 @@
 import os
-import json
 import argparse
 import xml.etree.ElementTree as ET
 
 from utils.data_handlers import load_pairs
+from llm_requests.store import STORES, open_store
 from xml.etree.ElementTree import Element, SubElement, ElementTree
 
 
-def process(method_name: str, responses_path: str, data_path: str, processed_responses_path: str):
+def process(method_name: str, responses_path: str, data_path: str, processed_responses_path: str,
+            store: str = "json"):
     # Create folders to save the responses
     gold_path = os.path.join(processed_responses_path, method_name + "_gold_predictions")
     cnd_path = os.path.join(processed_responses_path, method_name + "_candidate_predictions")
@@ -18,17 +19,12 @@ def process(method_name: str, responses_path: str, data_path: str, processed_res
     if not os.path.exists(cnd_path):
         os.makedirs(cnd_path)
 
-    # Read the files
-    json_files = os.listdir(responses_path)
-
-    # Check that all files are in json format
-    for f in json_files:
-        if not f.endswith(".json"):
-            print(f)
-        assert f.endswith(".json")
+    # Read the ids of the saved responses
+    result_store = open_store(store, responses_path)
+    unique_ids = set(result_store.ids())
 
     # Check that all the files are there
-    reports = list(set([f.split("_")[0] + ".xml" for f in json_files]))
+    reports = list(set([f.split("_")[0] + ".xml" for f in unique_ids]))
     assert len(reports) == 119
 
     # Load the gold
@@ -60,11 +56,10 @@ def process(method_name: str, responses_path: str, data_path: str, processed_res
     for r, report_id in enumerate(gold_pair_ids):
         root = Element("TAGS")
         for i, g_ids in enumerate(gold_pair_ids[report_id]):
-            json_f = report_id.replace(".xml", "") + "_" + g_ids[0] + "_" + g_ids[1] + ".json"
-            if json_f in json_files:
-                with open(os.path.join(responses_path, json_f)) as json_file:
-                    json_data = json.load(json_file)
-                    # print(json_data)
+            unique_id = report_id.replace(".xml", "") + "_" + g_ids[0] + "_" + g_ids[1]
+            if unique_id in unique_ids:
+                json_data = result_store.get(unique_id)
+                # print(json_data)
                 # Extract response
                 answers = json_data["answers"]
 
@@ -89,7 +84,7 @@ def process(method_name: str, responses_path: str, data_path: str, processed_res
                     # print(tlink)
                     tlink_elem = SubElement(root, 'TLINK', tlink)
             else:
-                print(json_f, "not found")
+                print(unique_id, "not found")
         tree = ElementTree(root)
         tree.write(os.path.join(gold_path, report_id))
 
@@ -99,11 +94,10 @@ def process(method_name: str, responses_path: str, data_path: str, processed_res
     for r, report_id in enumerate(cnd_pair_ids):
         root = Element("TAGS")
         for i, cnd_ids in enumerate(cnd_pair_ids[report_id]):
-            json_f = report_id.replace(".xml", "") + "_" + cnd_ids[0] + "_" + cnd_ids[1] + ".json"
-            if json_f in json_files:
-                with open(os.path.join(responses_path, json_f)) as json_file:
-                    json_data = json.load(json_file)
-                    # print(json_data)
+            unique_id = report_id.replace(".xml", "") + "_" + cnd_ids[0] + "_" + cnd_ids[1]
+            if unique_id in unique_ids:
+                json_data = result_store.get(unique_id)
+                # print(json_data)
                 # Extract response
                 answers = json_data["answers"]
 
@@ -127,11 +121,12 @@ def process(method_name: str, responses_path: str, data_path: str, processed_res
                              "type": rel}
                     tlink_elem = SubElement(root, 'TLINK', tlink)
             else:
-                print(json_f, "not found")
+                print(unique_id, "not found")
         tree = ElementTree(root)
         tree.write(os.path.join(cnd_path, report_id))
 
     print("Found errors in", len(errored_cnd), "responses for candidate pairs")
+    result_store.close()
 
 
 if __name__ == "__main__":
@@ -143,11 +138,15 @@ if __name__ == "__main__":
     argParser.add_argument("-data", "--data_path", help="The path where the gold and candidate pairs xml files "
                                                         "are saved")
     argParser.add_argument("-results", "--results_path", help="The path to save the processed responses")
+    argParser.add_argument("-store", "--store", help="How the responses are saved: one json file per pair "
+                                                     "(json) or a results.db database (sqlite)",
+                           choices=list(STORES.keys()), default="json")
 
     args = argParser.parse_args()
 
     process(method_name=args.method,
             responses_path=args.resp_path,
             data_path=args.data_path,
-            processed_responses_path=args.results_path
+            processed_responses_path=args.results_path,
+            store=args.store
             )